@@ -4,18 +4,52 @@ Weather Chatbot Application
 This module provides a Flask-based web application that serves as a weather chatbot.
 It allows users to get weather information and time for different locations.
 """
+import gzip
+import hashlib
+import heapq
+import hmac
 import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
+import queue
+import signal
+import sqlite3
+import struct
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from functools import lru_cache
-from typing import Dict, List, Optional, Tuple, Any, Union
+from fnmatch import fnmatchcase
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Any, Union
 import time
 
+try:
+    import fcntl
+except ImportError:  # Windows: la cache queda limitada al proceso
+    fcntl = None
+
+try:
+    import orjson  # opcional: serialización JSON más rápida
+except ImportError:
+    orjson = None
+
+try:
+    from flask_sock import Sock  # opcional: canal WebSocket
+except ImportError:
+    Sock = None
+
+import numpy as np
 import spacy
 import pytz
 import requests
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
 from timezonefinder import TimezoneFinder
 from spacy.lang.es.stop_words import STOP_WORDS as STOP_WORDS_SPACY
@@ -26,16 +60,108 @@ OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY", "5ca6fd1a510cf911fd089dcd
 OPENWEATHER_BASE_URL = "https://api.openweathermap.org"
 GEOCODING_ENDPOINT = "/geo/1.0/direct"
 WEATHER_ENDPOINT = "/data/2.5/weather"
+FORECAST_ENDPOINT = "/data/2.5/forecast"  # 5 días en intervalos de 3 horas
 REVERSE_GEOCODING_ENDPOINT = "/geo/1.0/reverse"
 
 # Request Configuration
 TIMEOUT = 15  # seconds
 MAX_RETRIES = 3
 
+# Upstream Quota Configuration (free OpenWeather tier)
+OPENWEATHER_LLAMADAS_POR_MINUTO = int(os.getenv("OPENWEATHER_LLAMADAS_POR_MINUTO", "60"))
+CUOTA_RESERVA_INTERACTIVA = 0.2  # fracción del presupuesto que las tareas de fondo no pueden usar
+
+# Shared Memory Configuration (archivos mapeados en memoria comunes a todos los workers)
+MEMORIA_COMPARTIDA_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# Conversation Context Configuration (almacén propio: las sesiones no desalojan la cache de consultas)
+CONTEXTO_RUTA = os.getenv("CONTEXTO_RUTA", os.path.join(MEMORIA_COMPARTIDA_DIR, 'servidordeclima_contexto.bin'))
+CONTEXTO_MAX_SESIONES = int(os.getenv("CONTEXTO_MAX_SESIONES", "2048"))
+CONTEXTO_TAMANO_SLOT = 512  # bytes
+CONTEXTO_TTL = 1800  # seconds sin actividad antes de olvidar la conversación
+CONTEXTO_MAX_LARGO_SESION = 64  # caracteres del identificador de sesión
+
+# NLP Analysis Cache Configuration
+ANALISIS_CACHE_MAX_ENTRADAS = int(os.getenv("ANALISIS_CACHE_MAX_ENTRADAS", "2048"))  # por worker
+ANALISIS_INVALIDACIONES_MAX = 20  # patrones recientes que se comparten con los demás workers
+ANALISIS_INVALIDACIONES_TTL = 30 * 24 * 3600  # seconds
+
+# NLP Process Pool Configuration (0 = analizar en el hilo de la petición)
+NLP_PROCESOS = int(os.getenv("NLP_PROCESOS", "0"))
+NLP_LOTE_MAX = int(os.getenv("NLP_LOTE_MAX", "16"))  # mensajes por llamada a nlp.pipe
+NLP_TIMEOUT = 10  # seconds esperando el análisis de un proceso
+
+# Admission Control Configuration (/chat, por worker de 4 hilos)
+CHAT_MAX_COSTOSAS = int(os.getenv("CHAT_MAX_COSTOSAS", "2"))  # consultas de clima simultáneas
+CHAT_COLA_COSTOSAS = int(os.getenv("CHAT_COLA_COSTOSAS", "1"))  # consultas de clima esperando turno
+CHAT_ESPERA_MAX_COSTOSAS = float(os.getenv("CHAT_ESPERA_MAX_COSTOSAS", "2"))  # seconds en cola antes del 503
+
+# Admin API Configuration (sin ADMIN_TOKEN la API de administración está desactivada)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+ADMIN_MAX_CLAVES = 10  # claves más consultadas por espacio
+PRECALENTAR_AL_INICIAR = os.getenv("PRECALENTAR_AL_INICIAR", "0") == "1"
+PRECALENTAR_MAX_INTENTOS = 5  # por ubicación cuando no queda cuota para tareas de fondo
+PRECALENTAR_ESPERA_MAX = 60  # seconds entre intentos
+PRECALENTAR_SIN_LATIDO = 300  # seconds sin progreso tras los que el precalentamiento se da por interrumpido
+PRECALENTAR_ESTADO_TTL = 86400  # seconds que se conserva el estado del último precalentamiento
+PRECALENTAR_MAX_DETALLES = 5  # ubicaciones pospuestas o con error que se detallan en el estado
+
+# Observation History Configuration (compartido por los workers)
+HISTORIAL_RUTA = os.getenv("HISTORIAL_RUTA", os.path.join(MEMORIA_COMPARTIDA_DIR, 'servidordeclima_historial.bin'))
+HISTORIAL_MAX_UBICACIONES = int(os.getenv("HISTORIAL_MAX_UBICACIONES", "256"))
+HISTORIAL_MUESTRAS = int(os.getenv("HISTORIAL_MUESTRAS", "288"))  # por ubicación: 48 h con datos cada 10 min
+HISTORIAL_MAX_HORAS = 48
+
+# CORS Configuration
+CORS_ORIGENES = os.getenv("CORS_ORIGENES", "*")  # lista separada por comas
+CORS_MAX_AGE = 86400  # seconds que el navegador puede reutilizar la respuesta preflight
+
+# WebSocket Configuration (cada conexión abierta ocupa un hilo de gunicorn mientras dure)
+WS_HABILITADO = os.getenv("WS_HABILITADO", "0") == "1"
+WS_MAX_CONEXIONES = int(os.getenv("WS_MAX_CONEXIONES", "1"))  # por worker, de 4 hilos
+WS_INACTIVIDAD = 300  # seconds sin mensajes antes de cerrar la conexión
+
+# HTTP Response Configuration
+HTTP_MAX_AGE_CLIMA = 300  # seconds; la mitad del TTL de la cache de clima
+RESPUESTA_COMPRIMIR_MIN_BYTES = 500
+
+# Multi-location Configuration
+CLIMA_MULTIPLE_MAX_UBICACIONES = 50
+CLIMA_MULTIPLE_CONCURRENCIA = 4  # llamadas simultáneas a la API por solicitud
+
+# Shared Cache Configuration
+CACHE_COMPARTIDA_RUTA = os.getenv("CACHE_COMPARTIDA_RUTA", os.path.join(MEMORIA_COMPARTIDA_DIR, 'servidordeclima_cache.bin'))
+CACHE_COMPARTIDA_SLOTS = int(os.getenv("CACHE_COMPARTIDA_SLOTS", "4096"))
+CACHE_COMPARTIDA_TAMANO_SLOT = int(os.getenv("CACHE_COMPARTIDA_TAMANO_SLOT", "2048"))  # bytes
+
+# Time to live (seconds) per kind of cached lookup
+CACHE_TTL = {
+    'geocoding': 7 * 24 * 3600,
+    'geocoding_vacio': 3600,      # ubicaciones no encontradas
+    'reverse': 7 * 24 * 3600,
+    'clima': 600,
+    'pronostico': 1800,
+    'zona_horaria': 30 * 24 * 3600
+}
+
+# Persistent Cache Configuration (snapshot used to start warm after a restart)
+CACHE_PERSISTENTE_RUTA = os.getenv(
+    "CACHE_PERSISTENTE_RUTA",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache_clima.sqlite3')
+)
+CACHE_PERSISTENTE_ESPACIOS = ('geocoding', 'reverse', 'zona_horaria')
+CACHE_PERSISTENTE_MAX_ENTRADAS = int(os.getenv("CACHE_PERSISTENTE_MAX_ENTRADAS", "50000"))  # por espacio
+CACHE_PERSISTENTE_COMPACTAR_CADA = 6 * 3600  # seconds entre compactaciones (en segundo plano, un worker)
+CACHE_PERSISTENTE_FRACCION_VACUUM = 0.25  # VACUUM solo si se borró al menos esta fracción de las filas
+
 # Chatbot Configuration
 SALUDOS = ["hola", "buenos días", "buenas tardes", "buenas noches", "hey", "saludos"]
 PALABRAS_CLIMA = ["clima", "tiempo", "temperatura", "pronóstico", "hace calor", "hace frío"]
 PALABRAS_HORA = ["hora", "qué horas son", "dime la hora"]
+PALABRAS_PRONOSTICO = ["pronóstico", "pronostico"]
+PALABRAS_DIA_SIGUIENTE = ["mañana"]  # pronóstico, salvo como parte del día ("esta mañana")
+PALABRAS_PARTE_DEL_DIA = ["esta", "la"]  # delante de "mañana" indican la mañana, no el día siguiente
+PALABRAS_TENDENCIA = ["subido", "bajado", "aumentado", "disminuido", "tendencia"]
 
 # Weather Icons Mapping
 WEATHER_ICONS = {
@@ -155,26 +281,17 @@ except OSError:
     print("Por favor instala el modelo de español de spaCy ejecutando: python -m spacy download es_core_news_sm")
     raise
 
-# Initialize Flask app
-app = Flask(__name__)
-
-# Configuración de CORS para producción
-cors = CORS(app, resources={
-    r"/*": {
-        "origins": [
-            "chatbotclima-b3dudba5fndahshv.centralus-01.azurewebsites.net",  # Tu dominio real en Azure
-            "http://localhost:3000",  # Para pruebas locales
-        ],
-        "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"],
-        "supports_credentials": True
-    }
-})
-
 class WeatherAPIError(Exception):
     """Custom exception for Weather API errors."""
     pass
 
+class CuotaAgotadaError(WeatherAPIError):
+    """Se agotó el presupuesto de llamadas a OpenWeather; reintentar tras ``retry_after`` segundos."""
+
+    def __init__(self, retry_after: float, mensaje: str = "Cuota de la API agotada"):
+        super().__init__(mensaje)
+        self.retry_after = retry_after
+
 # Update ZONAS_HORARIAS_PAIS with more specific entries
 ZONAS_HORARIAS_PAIS = {
     # Rusia y sus zonas horarias principales
@@ -236,12 +353,1039 @@ ZONAS_HORARIAS_PAIS = {
     'GT': ['America/Guatemala']
 }
 
+class MemoriaCompartida:
+    """
+    Región de memoria compartida por todos los workers de Gunicorn de un mismo host.
+
+    Es un archivo mapeado en memoria (por defecto en /dev/shm) que empieza con una
+    cabecera que identifica su formato; si no coincide, el archivo se reinicializa.
+    Las subclases acceden a ``self._mm`` dentro de ``_bloqueo()``, que combina un
+    bloqueo de archivo (entre procesos) y un lock de hilo (dentro del proceso).
+    """
+
+    def __init__(self, ruta: Optional[str], tamano: int, cabecera: bytes, descripcion: str):
+        """
+        Abre (o crea) la región compartida.
+
+        Args:
+            ruta: Archivo que respalda la memoria compartida. Con ``None`` (o sin
+                fcntl) la memoria queda limitada al proceso actual.
+            tamano: Tamaño total en bytes, cabecera incluida
+            cabecera: Bytes iniciales que identifican el formato
+            descripcion: Nombre de la región para los logs
+        """
+        self._lock = threading.Lock()
+        self._fd = None
+
+        if ruta and fcntl is not None:
+            try:
+                self._fd = self._abrir(ruta, tamano, cabecera)
+                self._mm = mmap.mmap(self._fd, tamano)
+                logger.info(f"🗄️ {descripcion} en {ruta} ({tamano // 1024} KiB)")
+            except OSError as e:
+                logger.warning(f"⚠️ No se pudo abrir {descripcion.lower()} en {ruta}: {e}. Se usará memoria local.")
+                if self._fd is not None:
+                    os.close(self._fd)
+                self._fd = None
+
+        if self._fd is None:
+            self._mm = mmap.mmap(-1, tamano)
+            self._mm[:len(cabecera)] = cabecera
+
+    @staticmethod
+    def _abrir(ruta: str, tamano: int, cabecera: bytes) -> int:
+        """
+        Abre el archivo de la región con el formato indicado y devuelve su descriptor.
+
+        Si el archivo existe con otro formato (p. ej. tras un reload de Gunicorn que cambió
+        el número de slots) no se trunca, porque los workers antiguos aún lo tienen mapeado:
+        se crea uno nuevo y se renombra encima. Los workers antiguos siguen con el suyo
+        hasta terminar y los nuevos comparten el nuevo.
+        """
+        while True:
+            fd = os.open(ruta, os.O_RDWR | os.O_CREAT, 0o600)
+            listo = False
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+                try:
+                    # Otro proceso pudo reemplazar el archivo mientras se esperaba el bloqueo
+                    if os.stat(ruta).st_ino == os.fstat(fd).st_ino:
+                        tamano_actual = os.fstat(fd).st_size
+                        if tamano_actual == tamano and os.pread(fd, len(cabecera), 0) == cabecera:
+                            listo = True
+                        elif tamano_actual == 0:
+                            # Archivo recién creado: nadie lo tiene mapeado todavía
+                            os.ftruncate(fd, tamano)
+                            os.pwrite(fd, cabecera, 0)
+                            listo = True
+                        else:
+                            descriptor, temporal = tempfile.mkstemp(
+                                dir=os.path.dirname(ruta) or '.', prefix=os.path.basename(ruta) + '.'
+                            )
+                            try:
+                                os.ftruncate(descriptor, tamano)
+                                os.pwrite(descriptor, cabecera, 0)
+                                os.replace(temporal, ruta)
+                            finally:
+                                os.close(descriptor)
+                            logger.info(f"🗄️ Formato distinto en {ruta}: se reemplaza el archivo")
+                finally:
+                    fcntl.lockf(fd, fcntl.LOCK_UN)
+            finally:
+                if not listo:
+                    os.close(fd)
+            if listo:
+                return fd
+            # Volver a abrir la ruta (ya con el archivo nuevo) y comprobarla bajo bloqueo
+
+    @contextmanager
+    def _bloqueo(self):
+        """Bloqueo exclusivo entre hilos y entre procesos."""
+        with self._lock:
+            if self._fd is not None:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if self._fd is not None:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _hash(clave: bytes) -> int:
+        h = int.from_bytes(hashlib.blake2b(clave, digest_size=8).digest(), 'little')
+        return h or 1  # 0 marca un slot vacío
+
+class CacheCompartida(MemoriaCompartida):
+    """
+    Cache clave-valor compartida por todos los workers de Gunicorn de un mismo host.
+
+    Los datos viven en un archivo mapeado en memoria (por defecto en /dev/shm) dividido
+    en slots de tamaño fijo, así que la memoria usada está acotada a
+    ``slots * tamano_slot`` bytes. Cada operación se realiza bajo un bloqueo de archivo
+    (entre procesos) y un lock de hilo (dentro del proceso), por lo que las
+    actualizaciones son atómicas. Las entradas caducan según su TTL y, al insertar,
+    se reutilizan primero los slots vacíos o expirados.
+
+    Los valores deben ser serializables a JSON; ``None`` se reserva para indicar
+    que la clave no está en la cache. Las entradas de ``ESPACIOS_PROTEGIDOS`` (estado
+    del limitador de cuota y tareas reclamadas por un solo worker) nunca se desalojan
+    para hacer sitio a otras; solo se reemplazan cuando caducan.
+    """
+
+    ESPACIOS_PROTEGIDOS = ('cuota', 'admin')
+
+    _MAGICO = b'SDCCACH1'
+    _CABECERA = struct.Struct('<8sII')   # mágico, número de slots, tamaño de slot
+    _SLOT = struct.Struct('<QdIHH')      # hash, expira, aciertos, longitud clave, longitud valor
+    _SONDEOS = 8                         # slots revisados por clave (sondeo lineal)
+
+    def __init__(self, ruta: Optional[str] = CACHE_COMPARTIDA_RUTA,
+                 slots: int = CACHE_COMPARTIDA_SLOTS,
+                 tamano_slot: int = CACHE_COMPARTIDA_TAMANO_SLOT):
+        """
+        Abre (o crea) el almacenamiento compartido.
+
+        Args:
+            ruta: Archivo que respalda la memoria compartida. Con ``None`` la cache
+                queda limitada al proceso actual.
+            slots: Número máximo de entradas
+            tamano_slot: Tamaño en bytes de cada entrada (cabecera + clave + valor)
+        """
+        self.slots = max(1, slots)
+        self.tamano_slot = min(tamano_slot, 0xFFFF)
+        self._espacios_protegidos = {espacio.encode('utf-8') for espacio in self.ESPACIOS_PROTEGIDOS}
+        self._consultas = {}  # espacio -> [aciertos, fallos] de este proceso
+        super().__init__(
+            ruta,
+            self._CABECERA.size + self.slots * self.tamano_slot,
+            self._CABECERA.pack(self._MAGICO, self.slots, self.tamano_slot),
+            f"Cache compartida ({self.slots} slots)"
+        )
+
+    @staticmethod
+    def _clave(espacio: str, clave: str) -> bytes:
+        return f"{espacio}:{clave}".encode('utf-8')
+
+    def _buscar(self, h: int, clave: bytes) -> Tuple[Optional[int], List[int]]:
+        """Devuelve el offset del slot que contiene la clave (o None) y los offsets candidatos."""
+        inicio = h % self.slots
+        candidatos = [
+            self._CABECERA.size + ((inicio + i) % self.slots) * self.tamano_slot
+            for i in range(min(self._SONDEOS, self.slots))
+        ]
+        for offset in candidatos:
+            h_slot, _, _, largo_clave, _ = self._SLOT.unpack_from(self._mm, offset)
+            if h_slot == h:
+                inicio_clave = offset + self._SLOT.size
+                if self._mm[inicio_clave:inicio_clave + largo_clave] == clave:
+                    return offset, candidatos
+        return None, candidatos
+
+    def _leer(self, offset: int, incluir_expirados: bool = False) -> Any:
+        _, expira, _, largo_clave, largo_valor = self._SLOT.unpack_from(self._mm, offset)
+        if not incluir_expirados and expira <= time.time():
+            return None
+        inicio = offset + self._SLOT.size + largo_clave
+        try:
+            return json.loads(self._mm[inicio:inicio + largo_valor])
+        except ValueError:
+            # Slot corrupto (p. ej. escrito con otro formato): se trata como un fallo
+            return None
+
+    def _protegida(self, offset: int, largo_clave: int) -> bool:
+        """Indica si el slot contiene una entrada de un espacio protegido."""
+        inicio = offset + self._SLOT.size
+        espacio = self._mm[inicio:inicio + largo_clave].split(b':', 1)[0]
+        return espacio in self._espacios_protegidos
+
+    def _escribir(self, h: int, clave: bytes, datos: bytes, expira: float) -> bool:
+        offset, candidatos = self._buscar(h, clave)
+        if offset is None:
+            # Preferir un slot vacío o expirado; si no hay, desalojar el que caduca antes
+            # salvo que pertenezca a un espacio protegido
+            ahora = time.time()
+            offset, expira_min = None, float('inf')
+            for candidato in candidatos:
+                h_slot, expira_slot, _, largo_clave, _ = self._SLOT.unpack_from(self._mm, candidato)
+                if h_slot == 0 or expira_slot <= ahora:
+                    offset = candidato
+                    break
+                if self._protegida(candidato, largo_clave):
+                    continue
+                if expira_slot < expira_min:
+                    offset, expira_min = candidato, expira_slot
+            if offset is None:
+                return False
+        self._SLOT.pack_into(self._mm, offset, h, expira, 0, len(clave), len(datos))
+        inicio = offset + self._SLOT.size
+        self._mm[inicio:inicio + len(clave)] = clave
+        self._mm[inicio + len(clave):inicio + len(clave) + len(datos)] = datos
+        return True
+
+    def _serializar(self, clave: bytes, valor: Any) -> Optional[bytes]:
+        datos = json.dumps(valor, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        if self._SLOT.size + len(clave) + len(datos) > self.tamano_slot:
+            logger.warning(f"⚠️ Valor demasiado grande para la cache ({len(datos)} bytes): {clave.decode('utf-8')}")
+            return None
+        return datos
+
+    def obtener(self, espacio: str, clave: str, incluir_expirados: bool = False, contar: bool = True) -> Any:
+        """
+        Obtiene un valor de la cache.
+
+        Args:
+            espacio: Tipo de dato cacheado (p. ej. 'geocoding', 'clima')
+            clave: Clave dentro del espacio
+            incluir_expirados: Devolver también valores caducados que aún no se han desalojado
+            contar: Registrar la consulta en las estadísticas (aciertos por clave y por worker)
+
+        Returns:
+            El valor guardado o None si no existe
+        """
+        clave_b = self._clave(espacio, clave)
+        h = self._hash(clave_b)
+        with self._bloqueo():
+            offset, _ = self._buscar(h, clave_b)
+            valor = self._leer(offset, incluir_expirados) if offset is not None else None
+            if not contar:
+                return valor
+            if valor is not None:
+                aciertos = struct.unpack_from('<I', self._mm, offset + 16)[0]
+                struct.pack_into('<I', self._mm, offset + 16, min(aciertos + 1, 0xFFFFFFFF))
+            if not incluir_expirados:
+                consultas = self._consultas.setdefault(espacio, [0, 0])
+                consultas[0 if valor is not None else 1] += 1
+            return valor
+
+    def contiene(self, espacio: str, clave: str) -> bool:
+        """Indica si hay un valor vigente para la clave, sin contarlo como consulta ni como acierto."""
+        clave_b = self._clave(espacio, clave)
+        h = self._hash(clave_b)
+        with self._bloqueo():
+            offset, _ = self._buscar(h, clave_b)
+            return offset is not None and self._SLOT.unpack_from(self._mm, offset)[1] > time.time()
+
+    def guardar(self, espacio: str, clave: str, valor: Any, ttl: float) -> bool:
+        """Guarda un valor con un TTL en segundos. Devuelve False si no cabe en un slot o no hay slot libre."""
+        clave_b = self._clave(espacio, clave)
+        datos = self._serializar(clave_b, valor)
+        if datos is None:
+            return False
+        h = self._hash(clave_b)
+        with self._bloqueo():
+            return self._escribir(h, clave_b, datos, time.time() + ttl)
+
+    def actualizar(self, espacio: str, clave: str, funcion: Callable[[Any], Any], ttl: float) -> Any:
+        """
+        Lee, transforma y guarda un valor de forma atómica entre todos los workers.
+
+        Args:
+            espacio: Tipo de dato cacheado
+            clave: Clave dentro del espacio
+            funcion: Recibe el valor actual (None si no existe o expiró) y devuelve el nuevo
+            ttl: TTL en segundos del nuevo valor
+
+        Returns:
+            El nuevo valor
+        """
+        clave_b = self._clave(espacio, clave)
+        h = self._hash(clave_b)
+        with self._bloqueo():
+            offset, _ = self._buscar(h, clave_b)
+            actual = self._leer(offset) if offset is not None else None
+            nuevo = funcion(actual)
+            datos = self._serializar(clave_b, nuevo)
+            if datos is not None:
+                self._escribir(h, clave_b, datos, time.time() + ttl)
+        return nuevo
+
+    def eliminar(self, espacio: str, clave: str) -> bool:
+        """Elimina una entrada. Devuelve True si existía."""
+        clave_b = self._clave(espacio, clave)
+        h = self._hash(clave_b)
+        with self._bloqueo():
+            offset, _ = self._buscar(h, clave_b)
+            if offset is None:
+                return False
+            self._mm[offset:offset + self._SLOT.size] = bytes(self._SLOT.size)
+            return True
+
+    def invalidar(self, patron: str) -> int:
+        """Elimina las entradas cuya clave 'espacio:clave' coincide con un patrón fnmatch. Devuelve cuántas."""
+        eliminadas = 0
+        with self._bloqueo():
+            for i in range(self.slots):
+                offset = self._CABECERA.size + i * self.tamano_slot
+                h, _, _, largo_clave, _ = self._SLOT.unpack_from(self._mm, offset)
+                if h == 0:
+                    continue
+                inicio = offset + self._SLOT.size
+                if fnmatchcase(self._mm[inicio:inicio + largo_clave].decode('utf-8', errors='replace'), patron):
+                    self._mm[offset:offset + self._SLOT.size] = bytes(self._SLOT.size)
+                    eliminadas += 1
+        return eliminadas
+
+    def inspeccionar(self, max_claves: int = ADMIN_MAX_CLAVES) -> Dict[str, Any]:
+        """
+        Describe el contenido de la cache por espacio.
+
+        Returns:
+            Diccionario con la memoria reservada y, por espacio, entradas vigentes y
+            expiradas, bytes ocupados, aciertos acumulados por todos los workers, tasa de
+            aciertos de este proceso y las claves con más aciertos
+        """
+        ahora = time.time()
+        espacios = {}
+        with self._bloqueo():
+            for i in range(self.slots):
+                offset = self._CABECERA.size + i * self.tamano_slot
+                h, expira, aciertos, largo_clave, largo_valor = self._SLOT.unpack_from(self._mm, offset)
+                if h == 0:
+                    continue
+                inicio = offset + self._SLOT.size
+                espacio, _, clave = self._mm[inicio:inicio + largo_clave].decode('utf-8', errors='replace').partition(':')
+                datos = espacios.setdefault(espacio, {'entradas': 0, 'expiradas': 0, 'bytes': 0, 'aciertos': 0, 'claves': []})
+                if expira <= ahora:
+                    datos['expiradas'] += 1
+                    continue
+                datos['entradas'] += 1
+                datos['bytes'] += self._SLOT.size + largo_clave + largo_valor
+                datos['aciertos'] += aciertos
+                datos['claves'].append((aciertos, clave))
+            consultas = {espacio: tuple(valores) for espacio, valores in self._consultas.items()}
+
+        for espacio in consultas:
+            espacios.setdefault(espacio, {'entradas': 0, 'expiradas': 0, 'bytes': 0, 'aciertos': 0, 'claves': []})
+        for espacio, datos in espacios.items():
+            aciertos, fallos = consultas.get(espacio, (0, 0))
+            datos['tasa_aciertos_worker'] = round(aciertos / (aciertos + fallos), 4) if aciertos + fallos else 0.0
+            datos['claves_frecuentes'] = [
+                {'clave': clave, 'aciertos': aciertos} for aciertos, clave in heapq.nlargest(max_claves, datos.pop('claves')) if aciertos
+            ]
+        return {
+            'slots': self.slots,
+            'tamano_slot': self.tamano_slot,
+            'bytes_reservados': self.slots * self.tamano_slot,
+            'compartida': self._fd is not None,
+            'espacios': espacios
+        }
+
+    def limpiar(self) -> None:
+        """Vacía toda la cache."""
+        with self._bloqueo():
+            self._mm[self._CABECERA.size:] = bytes(len(self._mm) - self._CABECERA.size)
+
+class CacheLRU:
+    """Cache LRU acotada y thread-safe, local al proceso, con estadísticas de aciertos."""
+
+    def __init__(self, max_entradas: int):
+        self.max_entradas = max(1, max_entradas)
+        self._datos = OrderedDict()
+        self._aciertos_clave = {}
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, clave: str) -> Any:
+        """Devuelve el valor (marcándolo como usado recientemente) o None si no está."""
+        with self._lock:
+            if clave in self._datos:
+                self._datos.move_to_end(clave)
+                self.aciertos += 1
+                self._aciertos_clave[clave] = self._aciertos_clave.get(clave, 0) + 1
+                return self._datos[clave]
+            self.fallos += 1
+            return None
+
+    def consultar(self, clave: str) -> Any:
+        """Devuelve el valor sin marcarlo como usado ni contar la consulta, o None si no está."""
+        with self._lock:
+            return self._datos.get(clave)
+
+    def guardar(self, clave: str, valor: Any) -> None:
+        """Guarda un valor, descartando el menos usado si se supera el máximo."""
+        with self._lock:
+            self._datos[clave] = valor
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                descartada, _ = self._datos.popitem(last=False)
+                self._aciertos_clave.pop(descartada, None)
+
+    def invalidar(self, patron: str, prefijo: str = '') -> int:
+        """Elimina las claves que (precedidas de ``prefijo``) coinciden con un patrón fnmatch. Devuelve cuántas."""
+        with self._lock:
+            claves = [clave for clave in self._datos if fnmatchcase(prefijo + clave, patron)]
+            for clave in claves:
+                del self._datos[clave]
+                self._aciertos_clave.pop(clave, None)
+            return len(claves)
+
+    def limpiar(self) -> None:
+        """Vacía la cache y reinicia las estadísticas."""
+        with self._lock:
+            self._datos.clear()
+            self._aciertos_clave.clear()
+            self.aciertos = 0
+            self.fallos = 0
+
+    def estadisticas(self) -> Dict[str, Any]:
+        """Número de entradas, aciertos, fallos y tasa de aciertos."""
+        with self._lock:
+            consultas = self.aciertos + self.fallos
+            return {
+                'entradas': len(self._datos),
+                'max_entradas': self.max_entradas,
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'tasa_aciertos': round(self.aciertos / consultas, 4) if consultas else 0.0
+            }
+
+    def inspeccionar(self, max_claves: int = ADMIN_MAX_CLAVES) -> Dict[str, Any]:
+        """Estadísticas más el tamaño aproximado en bytes (JSON) y las claves con más aciertos."""
+        with self._lock:
+            datos = list(self._datos.items())
+            frecuentes = heapq.nlargest(max_claves, self._aciertos_clave.items(), key=lambda item: item[1])
+        resultado = self.estadisticas()
+        resultado['bytes'] = sum(len(clave.encode('utf-8')) + len(json.dumps(valor, ensure_ascii=False).encode('utf-8'))
+                                 for clave, valor in datos)
+        resultado['claves_frecuentes'] = [{'clave': clave, 'aciertos': aciertos} for clave, aciertos in frecuentes]
+        return resultado
+
+class HistorialObservaciones(MemoriaCompartida):
+    """
+    Historial de observaciones del clima por ubicación, compartido por los workers.
+    
+    Cada ubicación ocupa un registro de tamaño fijo en memoria compartida con un buffer
+    circular (marcas de tiempo y una fila por observación con los campos de ``CAMPOS``),
+    al que se accede mediante vistas de NumPy sobre el mmap. Se conservan como máximo
+    ``max_ubicaciones`` ubicaciones, reutilizando la consultada hace más tiempo.
+    """
+
+    CAMPOS = ('temp', 'feels_like', 'humidity', 'wind_speed', 'pressure')
+    _MAGICO = b'SDCHIST1'
+    _CABECERA = struct.Struct('<8sIII')  # mágico, ubicaciones, muestras, campos
+    _INICIO_DATOS = 64                   # los registros empiezan alineados tras la cabecera
+    _LARGO_NOMBRE = 64
+
+    def __init__(self, ruta: Optional[str] = HISTORIAL_RUTA,
+                 max_ubicaciones: int = HISTORIAL_MAX_UBICACIONES, muestras: int = HISTORIAL_MUESTRAS):
+        """
+        Abre (o crea) el historial compartido.
+
+        Args:
+            ruta: Archivo que respalda la memoria compartida. Con ``None`` el historial
+                queda limitado al proceso actual.
+            max_ubicaciones: Número máximo de ubicaciones con historial
+            muestras: Observaciones guardadas por ubicación
+        """
+        self.max_ubicaciones = max(1, max_ubicaciones)
+        self.muestras = max(2, muestras)
+        self._dtype = np.dtype([
+            ('hash', '<u8'),
+            ('usado', '<f8'),
+            ('escritas', '<u8'),
+            ('nombre', f'S{self._LARGO_NOMBRE}'),
+            ('ts', '<f8', (self.muestras,)),
+            ('valores', '<f4', (self.muestras, len(self.CAMPOS)))
+        ])
+        super().__init__(
+            ruta,
+            self._INICIO_DATOS + self.max_ubicaciones * self._dtype.itemsize,
+            self._CABECERA.pack(self._MAGICO, self.max_ubicaciones, self.muestras, len(self.CAMPOS)),
+            f"Historial compartido ({self.max_ubicaciones} ubicaciones)"
+        )
+        self._registros = np.ndarray(
+            (self.max_ubicaciones,), dtype=self._dtype, buffer=self._mm, offset=self._INICIO_DATOS
+        )
+
+    def _indice(self, h: int) -> Optional[int]:
+        """Posición del registro de la ubicación con hash ``h`` (llamar con el bloqueo tomado)."""
+        encontrados = np.flatnonzero(self._registros['hash'] == h)
+        return int(encontrados[0]) if len(encontrados) else None
+
+    def registrar(self, clave: str, nombre: str, ts: float, datos: Dict[str, Any]) -> bool:
+        """
+        Añade una observación si es más reciente que la última registrada para la ubicación.
+        
+        Args:
+            clave: Identificador de la ubicación (coordenadas redondeadas)
+            nombre: Nombre de la ubicación para mostrar
+            ts: Momento de la medición (segundos desde epoch, el 'dt' de OpenWeather)
+            datos: Respuesta de clima con los campos de ``CAMPOS``
+            
+        Returns:
+            True si se registró; False si la medición ya estaba (registrada por este
+            u otro worker)
+        """
+        fila = [float(datos.get(campo) or 0.0) for campo in self.CAMPOS]
+        h = self._hash(clave.encode('utf-8'))
+        registros = self._registros
+        with self._bloqueo():
+            i = self._indice(h)
+            if i is None:
+                libres = np.flatnonzero(registros['hash'] == 0)
+                i = int(libres[0]) if len(libres) else int(np.argmin(registros['usado']))
+                registros['hash'][i] = h
+                registros['nombre'][i] = nombre.encode('utf-8')[:self._LARGO_NOMBRE]
+                registros['escritas'][i] = 0
+            registros['usado'][i] = time.time()
+            escritas = int(registros['escritas'][i])
+            if escritas and ts <= registros['ts'][i, (escritas - 1) % self.muestras]:
+                return False
+            posicion = escritas % self.muestras
+            registros['ts'][i, posicion] = ts
+            registros['valores'][i, posicion] = fila
+            registros['escritas'][i] = escritas + 1
+            return True
+
+    def resumen(self, clave: str, horas: float) -> Optional[Dict[str, Any]]:
+        """
+        Resume las observaciones de las últimas ``horas`` de una ubicación.
+        
+        Returns:
+            Diccionario con mínimo, máximo, media, cambio total, pendiente por hora y
+            variación entre horas consecutivas de cada campo, o None si no hay datos
+        """
+        registros = self._registros
+        with self._bloqueo():
+            i = self._indice(self._hash(clave.encode('utf-8')))
+            if i is None:
+                return None
+            escritas = int(registros['escritas'][i])
+            # Copias en orden cronológico (el buffer se reescribe desde la posición más antigua)
+            desplazamiento = escritas % self.muestras if escritas > self.muestras else 0
+            n = min(escritas, self.muestras)
+            ts = np.roll(registros['ts'][i], -desplazamiento)[:n]
+            valores = np.roll(registros['valores'][i], -desplazamiento, axis=0)[:n].astype(np.float64)
+            nombre = registros['nombre'][i].decode('utf-8', errors='ignore')
+
+        en_ventana = ts >= time.time() - horas * 3600
+        ts, valores = ts[en_ventana], valores[en_ventana]
+        if len(ts) == 0:
+            return None
+
+        # Pendiente por mínimos cuadrados de todos los campos a la vez (unidades por hora)
+        t = (ts - ts.mean()) / 3600
+        varianza = float(t @ t)
+        pendiente = (t @ (valores - valores.mean(axis=0))) / varianza if varianza else np.zeros(len(self.CAMPOS))
+
+        # Última observación de cada hora y su variación respecto a la hora anterior
+        hora = (ts // 3600).astype(np.int64)
+        ultimas = np.flatnonzero(np.append(hora[1:] != hora[:-1], True))
+        deltas = np.diff(valores[ultimas], axis=0)
+
+        def por_campo(fila: np.ndarray) -> Dict[str, float]:
+            return {campo: round(float(v), 2) for campo, v in zip(self.CAMPOS, fila)}
+
+        return {
+            'location': nombre,
+            'observaciones': int(len(ts)),
+            'desde': datetime.fromtimestamp(float(ts[0]), tz=pytz.utc).isoformat(),
+            'hasta': datetime.fromtimestamp(float(ts[-1]), tz=pytz.utc).isoformat(),
+            'min': por_campo(valores.min(axis=0)),
+            'max': por_campo(valores.max(axis=0)),
+            'media': por_campo(valores.mean(axis=0)),
+            'cambio': por_campo(valores[-1] - valores[0]),
+            'pendiente_por_hora': por_campo(pendiente),
+            'deltas_por_hora': [
+                {'hora': datetime.fromtimestamp(float(h) * 3600, tz=pytz.utc).isoformat(), **por_campo(d)}
+                for h, d in zip(hora[ultimas[1:]], deltas)
+            ]
+        }
+
+    def estadisticas(self) -> Dict[str, Any]:
+        """Ubicaciones con historial, observaciones guardadas y memoria reservada para los buffers."""
+        registros = self._registros
+        with self._bloqueo():
+            usadas = registros['hash'] != 0
+            observaciones = int(np.minimum(registros['escritas'][usadas], self.muestras).sum())
+            return {
+                'ubicaciones': int(usadas.sum()),
+                'max_ubicaciones': self.max_ubicaciones,
+                'muestras_por_ubicacion': self.muestras,
+                'observaciones': observaciones,
+                'bytes_reservados': len(self._mm),
+                'compartida': self._fd is not None
+            }
+
+class AlmacenPersistente:
+    """
+    Almacén SQLite con las resoluciones que sobreviven a reinicios y despliegues.
+
+    Guarda geocoding, nombres de reverse geocoding y zonas horarias por coordenadas
+    (ver ``CACHE_PERSISTENTE_ESPACIOS``), cada uno con su TTL. Al arrancar, su contenido
+    se vuelca en la cache compartida para que el proceso empiece con la cache caliente.
+    Las entradas caducadas y las que exceden el máximo por espacio se eliminan al compactar.
+    """
+
+    def __init__(self, ruta: str = CACHE_PERSISTENTE_RUTA,
+                 espacios: Tuple[str, ...] = CACHE_PERSISTENTE_ESPACIOS,
+                 max_entradas: int = CACHE_PERSISTENTE_MAX_ENTRADAS):
+        self.ruta = ruta
+        self.espacios = espacios
+        self.max_entradas = max_entradas
+        self._lock = threading.Lock()
+        self._conexion = None
+        try:
+            self._conexion = sqlite3.connect(ruta, timeout=5, check_same_thread=False, isolation_level=None)
+            # Sin WAL: su índice en memoria compartida no funciona en recursos de red como /home en Azure
+            self._conexion.execute('PRAGMA journal_mode=TRUNCATE')
+            self._conexion.execute('PRAGMA synchronous=NORMAL')
+            self._conexion.execute(
+                'CREATE TABLE IF NOT EXISTS entradas ('
+                ' espacio TEXT NOT NULL, clave TEXT NOT NULL, valor TEXT NOT NULL, expira REAL NOT NULL,'
+                ' PRIMARY KEY (espacio, clave))'
+            )
+            self._conexion.execute('CREATE INDEX IF NOT EXISTS idx_entradas_expira ON entradas (espacio, expira)')
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ No se pudo abrir la cache persistente en {ruta}: {e}")
+            self._conexion = None
+
+    def guardar(self, espacio: str, clave: str, valor: Any, ttl: float) -> None:
+        """Guarda una entrada si su espacio es persistente."""
+        if self._conexion is None or espacio not in self.espacios:
+            return
+        try:
+            with self._lock:
+                self._conexion.execute(
+                    'INSERT OR REPLACE INTO entradas (espacio, clave, valor, expira) VALUES (?, ?, ?, ?)',
+                    (espacio, clave, json.dumps(valor, ensure_ascii=False), time.time() + ttl)
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Error al escribir en la cache persistente: {e}")
+
+    def obtener(self, espacio: str, clave: str) -> Tuple[Any, float]:
+        """Devuelve el valor y su TTL restante en segundos, o (None, 0) si no existe o caducó."""
+        if self._conexion is None or espacio not in self.espacios:
+            return None, 0
+        try:
+            with self._lock:
+                fila = self._conexion.execute(
+                    'SELECT valor, expira FROM entradas WHERE espacio = ? AND clave = ? AND expira > ?',
+                    (espacio, clave, time.time())
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Error al leer la cache persistente: {e}")
+            return None, 0
+        if fila is None:
+            return None, 0
+        return json.loads(fila[0]), fila[1] - time.time()
+
+    def precargar(self, cache: CacheCompartida) -> int:
+        """
+        Vuelca en la cache compartida las entradas vigentes escritas más recientemente,
+        tantas como slots tiene la cache. Devuelve cuántas se cargaron.
+        """
+        if self._conexion is None:
+            return 0
+        ahora = time.time()
+        try:
+            with self._lock:
+                filas = self._conexion.execute(
+                    'SELECT espacio, clave, valor, expira FROM entradas WHERE expira > ?'
+                    ' ORDER BY rowid DESC LIMIT ?', (ahora, cache.slots)
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Error al precargar la cache persistente: {e}")
+            return 0
+        # Las más recientes se escriben al final para que prevalezcan si compiten por un slot
+        for espacio, clave, valor, expira in reversed(filas):
+            cache.guardar(espacio, clave, json.loads(valor), expira - ahora)
+        logger.info(f"🗄️ Cache precargada con {len(filas)} entradas de {self.ruta}")
+        return len(filas)
+
+    def invalidar(self, patron: str) -> int:
+        """Elimina las entradas cuya clave 'espacio:clave' coincide con un patrón fnmatch. Devuelve cuántas."""
+        if self._conexion is None:
+            return 0
+        try:
+            with self._lock:
+                filas = self._conexion.execute('SELECT espacio, clave FROM entradas').fetchall()
+                borrar = [fila for fila in filas if fnmatchcase(f"{fila[0]}:{fila[1]}", patron)]
+                self._conexion.executemany('DELETE FROM entradas WHERE espacio = ? AND clave = ?', borrar)
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Error al invalidar la cache persistente: {e}")
+            return 0
+        if borrar:
+            logger.info(f"🗄️ Cache persistente: {len(borrar)} entradas invalidadas con '{patron}'")
+        return len(borrar)
+
+    def compactar(self) -> int:
+        """Elimina entradas caducadas y las más antiguas por encima del máximo. Devuelve cuántas borró."""
+        if self._conexion is None:
+            return 0
+        try:
+            with self._lock:
+                total = self._conexion.execute('SELECT COUNT(*) FROM entradas').fetchone()[0]
+                borradas = self._conexion.execute(
+                    'DELETE FROM entradas WHERE expira <= ?', (time.time(),)
+                ).rowcount
+                for espacio in self.espacios:
+                    borradas += self._conexion.execute(
+                        'DELETE FROM entradas WHERE espacio = ? AND clave IN ('
+                        ' SELECT clave FROM entradas WHERE espacio = ? ORDER BY expira DESC LIMIT -1 OFFSET ?)',
+                        (espacio, espacio, self.max_entradas)
+                    ).rowcount
+                # Reescribir el archivo solo si vale la pena: VACUUM copia toda la base
+                if borradas and borradas >= total * CACHE_PERSISTENTE_FRACCION_VACUUM:
+                    self._conexion.execute('VACUUM')
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Error al compactar la cache persistente: {e}")
+            return 0
+        if borradas:
+            logger.info(f"🗄️ Cache persistente compactada: {borradas} entradas eliminadas")
+        return borradas
+
+    def compactar_periodicamente(self, cache: CacheCompartida,
+                                 intervalo: float = CACHE_PERSISTENTE_COMPACTAR_CADA) -> None:
+        """
+        Lanza un hilo en segundo plano que compacta el almacén cada ``intervalo`` segundos.
+        
+        Cada worker tiene su hilo, pero en cada intervalo solo compacta el primero que
+        reclama la tarea en la cache compartida, fuera del camino de las peticiones.
+        """
+        if self._conexion is None:
+            return
+
+        def bucle():
+            while True:
+                time.sleep(intervalo)
+                ahora = time.time()
+                reclamado = cache.actualizar(
+                    'admin', 'compactacion',
+                    lambda actual: actual if actual and ahora - actual['ts'] < intervalo
+                    else {'pid': os.getpid(), 'ts': ahora},
+                    ttl=2 * intervalo
+                )
+                if reclamado == {'pid': os.getpid(), 'ts': ahora}:
+                    self.compactar()
+
+        threading.Thread(target=bucle, name='compactacion', daemon=True).start()
+
+class LimitadorCuota:
+    """
+    Token bucket compartido por todos los workers frente a las llamadas a OpenWeather.
+
+    El estado (tokens disponibles y contadores por endpoint) vive en la cache compartida
+    y se modifica con ``CacheCompartida.actualizar``, de modo que el límite es global
+    al host y no por worker. Cuando no quedan tokens la llamada se rechaza de inmediato
+    en lugar de esperar, para que el llamador responda "ocupado" o con datos obsoletos.
+    """
+
+    _ESPACIO = 'cuota'
+    _CLAVE = 'openweather'
+
+    def __init__(self, cache: CacheCompartida, llamadas_por_minuto: int = OPENWEATHER_LLAMADAS_POR_MINUTO):
+        self.cache = cache
+        self.capacidad = max(1, llamadas_por_minuto)
+        self.tasa = self.capacidad / 60.0  # tokens por segundo
+
+    def _estado_inicial(self, ahora: float) -> Dict:
+        return {'tokens': float(self.capacidad), 'ts': ahora, 'bloqueado_hasta': 0.0,
+                'llamadas': {}, 'rechazos': {}}
+
+    def consumir(self, endpoint: str, prioridad: str = 'interactiva') -> float:
+        """
+        Intenta consumir un token para una llamada a ``endpoint``.
+
+        Args:
+            endpoint: Endpoint de OpenWeather, para la contabilidad por endpoint
+            prioridad: 'interactiva' o 'fondo'; las de fondo no usan la reserva interactiva
+
+        Returns:
+            0 si la llamada está admitida; si no, segundos hasta que habrá cuota
+        """
+        espera = 0.0
+
+        def actualizar(estado: Optional[Dict]) -> Dict:
+            nonlocal espera
+            ahora = time.time()
+            estado = estado or self._estado_inicial(ahora)
+            estado['tokens'] = min(self.capacidad, estado['tokens'] + (ahora - estado['ts']) * self.tasa)
+            estado['ts'] = ahora
+            minimo = 1.0 + (self.capacidad * CUOTA_RESERVA_INTERACTIVA if prioridad == 'fondo' else 0.0)
+            if ahora < estado['bloqueado_hasta']:
+                espera = estado['bloqueado_hasta'] - ahora
+            elif estado['tokens'] < minimo:
+                espera = (minimo - estado['tokens']) / self.tasa
+            if espera > 0:
+                estado['rechazos'][endpoint] = estado['rechazos'].get(endpoint, 0) + 1
+            else:
+                estado['tokens'] -= 1
+                estado['llamadas'][endpoint] = estado['llamadas'].get(endpoint, 0) + 1
+            return estado
+
+        self.cache.actualizar(self._ESPACIO, self._CLAVE, actualizar, ttl=24 * 3600)
+        return espera
+
+    def bloquear(self, segundos: float) -> None:
+        """Vacía el bucket y bloquea nuevas llamadas (p. ej. tras un 429 de la API)."""
+        def actualizar(estado: Optional[Dict]) -> Dict:
+            ahora = time.time()
+            estado = estado or self._estado_inicial(ahora)
+            estado['tokens'] = 0.0
+            estado['ts'] = ahora
+            estado['bloqueado_hasta'] = max(estado['bloqueado_hasta'], ahora + segundos)
+            return estado
+
+        self.cache.actualizar(self._ESPACIO, self._CLAVE, actualizar, ttl=24 * 3600)
+
+    def estado(self) -> Dict:
+        """Tokens disponibles y llamadas/rechazos acumulados por endpoint."""
+        estado = self.cache.obtener(self._ESPACIO, self._CLAVE) or self._estado_inicial(time.time())
+        tokens = min(self.capacidad, estado['tokens'] + (time.time() - estado['ts']) * self.tasa)
+        return {
+            'capacidad_por_minuto': self.capacidad,
+            'tokens_disponibles': round(tokens, 2),
+            'bloqueado_hasta': estado['bloqueado_hasta'],
+            'llamadas': estado['llamadas'],
+            'rechazos': estado['rechazos']
+        }
+
+# Chatbot de cada proceso del pool NLP (heredado por fork, con el modelo ya cargado)
+_chatbot_proceso = None
+
+def _inicializar_proceso_nlp(chatbot: 'ChatbotClima') -> None:
+    """Prepara un proceso del pool NLP: guarda el chatbot heredado y restaura las señales."""
+    global _chatbot_proceso
+    _chatbot_proceso = chatbot
+    # El proceso hereda los manejadores de gunicorn; de su ciclo de vida se encarga el padre
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def _analizar_lote_en_proceso(mensajes: List[str]) -> List[Dict[str, Any]]:
+    """Analiza un lote de mensajes dentro de un proceso del pool NLP."""
+    return _chatbot_proceso.analizar_lote(mensajes)
+
+class AnalizadorEnProcesos:
+    """
+    Envía el análisis NLP a un pool de procesos para que no compita por el GIL
+    con los hilos de gunicorn que esperan E/S.
+    
+    Los procesos se crean por fork al construir el analizador, antes de que el worker
+    arranque sus hilos, y heredan el modelo de spaCy ya cargado. Un hilo despachador
+    solo envía un lote cuando hay un proceso libre: con poca carga cada mensaje va solo,
+    y bajo carga los mensajes que esperan se agrupan en una misma llamada a ``nlp.pipe``.
+    """
+
+    def __init__(self, chatbot: 'ChatbotClima', procesos: int, lote_max: int = NLP_LOTE_MAX):
+        """
+        Args:
+            chatbot: Chatbot cuyo análisis ejecutarán los procesos
+            procesos: Número de procesos del pool
+            lote_max: Máximo de mensajes por lote
+            
+        Raises:
+            ValueError: Si la plataforma no permite crear procesos por fork
+        """
+        self.procesos = procesos
+        self.lote_max = max(1, lote_max)
+        self._pool = ProcessPoolExecutor(
+            max_workers=procesos,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_inicializar_proceso_nlp,
+            initargs=(chatbot,)
+        )
+        # Con fork todos los procesos se crean en el primer envío: hacerlo ahora, sin hilos vivos
+        self._pool.submit(_analizar_lote_en_proceso, ['hola']).result()
+        self._cola = queue.Queue()
+        self._libres = threading.Semaphore(procesos)
+        self._lock = threading.Lock()
+        self.lotes = 0
+        self.mensajes = 0
+        threading.Thread(target=self._despachar, name='nlp-despachador', daemon=True).start()
+
+    def analizar(self, mensaje: str) -> Dict[str, Any]:
+        """
+        Analiza un mensaje en el pool y espera el resultado.
+        
+        Raises:
+            Exception: Si el pool no está disponible o el análisis falla
+        """
+        futuro = Future()
+        self._cola.put((mensaje, futuro))
+        return futuro.result(timeout=NLP_TIMEOUT)
+
+    def _despachar(self) -> None:
+        """Agrupa los mensajes pendientes en lotes y los envía al pool."""
+        while True:
+            lote = [self._cola.get()]
+            # Mientras todos los procesos están ocupados, los mensajes se acumulan en la cola
+            self._libres.acquire()
+            while len(lote) < self.lote_max:
+                try:
+                    lote.append(self._cola.get_nowait())
+                except queue.Empty:
+                    break
+            futuros = [futuro for _, futuro in lote]
+            try:
+                resultado = self._pool.submit(_analizar_lote_en_proceso, [mensaje for mensaje, _ in lote])
+            except Exception as e:
+                self._libres.release()
+                for futuro in futuros:
+                    futuro.set_exception(e)
+                continue
+            with self._lock:
+                self.lotes += 1
+                self.mensajes += len(lote)
+            resultado.add_done_callback(lambda r, futuros=futuros: self._resolver(futuros, r))
+
+    def _resolver(self, futuros: List[Future], resultado: Future) -> None:
+        """Reparte el resultado de un lote entre las peticiones que lo esperan."""
+        self._libres.release()
+        try:
+            analisis = resultado.result()
+        except Exception as e:
+            for futuro in futuros:
+                futuro.set_exception(e)
+            return
+        for futuro, datos in zip(futuros, analisis):
+            futuro.set_result(datos)
+
+    def estadisticas(self) -> Dict[str, Any]:
+        """Procesos, lotes enviados y tamaño medio de lote."""
+        with self._lock:
+            return {
+                'procesos': self.procesos,
+                'lotes': self.lotes,
+                'mensajes': self.mensajes,
+                'tamano_medio_lote': round(self.mensajes / self.lotes, 2) if self.lotes else 0.0
+            }
+
+class ControlAdmision:
+    """
+    Control de admisión por costo estimado para los hilos de un worker.
+
+    Las peticiones baratas pasan siempre. Las costosas (las que consultan la API del
+    clima) se limitan a ``max_en_curso`` simultáneas, con una cola de ``max_en_cola``
+    peticiones que esperan como máximo ``espera_max`` segundos; el resto se rechaza de
+    inmediato. Así las costosas nunca ocupan todos los hilos y las baratas no esperan
+    detrás de ellas.
+    """
+
+    def __init__(self, max_en_curso: int = CHAT_MAX_COSTOSAS, max_en_cola: int = CHAT_COLA_COSTOSAS,
+                 espera_max: float = CHAT_ESPERA_MAX_COSTOSAS):
+        self.max_en_curso = max(1, max_en_curso)
+        self.max_en_cola = max(0, max_en_cola)
+        self.espera_max = espera_max
+        self._condicion = threading.Condition()
+        self.en_curso = 0
+        self.en_cola = 0
+        self.contadores = {'baratas': 0, 'costosas': 0, 'rechazadas': 0, 'ms_espera': 0.0, 'ms_costosas': 0.0}
+
+    def _admitir_costosa(self) -> bool:
+        """Reserva un hueco del carril costoso, esperando en cola si hay sitio."""
+        with self._condicion:
+            if self.en_curso >= self.max_en_curso:
+                if self.en_cola >= self.max_en_cola:
+                    self.contadores['rechazadas'] += 1
+                    return False
+                self.en_cola += 1
+                inicio = time.perf_counter()
+                try:
+                    admitida = self._condicion.wait_for(lambda: self.en_curso < self.max_en_curso,
+                                                        timeout=self.espera_max)
+                finally:
+                    self.en_cola -= 1
+                    self.contadores['ms_espera'] += (time.perf_counter() - inicio) * 1000
+                if not admitida:
+                    self.contadores['rechazadas'] += 1
+                    return False
+            self.en_curso += 1
+            return True
+
+    @contextmanager
+    def carril(self, costo: str) -> Iterator[bool]:
+        """
+        Admite una petición según su costo ('barata' o 'costosa').
+
+        Yields:
+            True si la petición puede atenderse; False si debe rechazarse con 503
+        """
+        if costo != 'costosa':
+            with self._condicion:
+                self.contadores['baratas'] += 1
+            yield True
+            return
+        if not self._admitir_costosa():
+            yield False
+            return
+        inicio = time.perf_counter()
+        try:
+            yield True
+        finally:
+            with self._condicion:
+                self.en_curso -= 1
+                self.contadores['costosas'] += 1
+                self.contadores['ms_costosas'] += (time.perf_counter() - inicio) * 1000
+                self._condicion.notify()
+
+    def reintentar_en(self) -> float:
+        """Segundos sugeridos para reintentar: la duración media de una petición costosa."""
+        with self._condicion:
+            atendidas = self.contadores['costosas']
+            return self.contadores['ms_costosas'] / atendidas / 1000 if atendidas else 1.0
+
+    def estadisticas(self) -> Dict[str, Any]:
+        """Peticiones atendidas por carril, rechazadas y ocupación actual del carril costoso."""
+        with self._condicion:
+            return {
+                **{clave: round(valor, 2) for clave, valor in self.contadores.items()},
+                'costosas_en_curso': self.en_curso,
+                'costosas_en_cola': self.en_cola,
+                'max_en_curso': self.max_en_curso,
+                'max_en_cola': self.max_en_cola
+            }
+
 class ChatbotClima:
-    def obtener_zona_horaria(self, lat: float, lon: float, codigo_pais: str = None, pais_usuario: str = None) -> dict:
-        """Obtiene la zona horaria y hora local basada en coordenadas y código de país."""
+    def obtener_zona_horaria(self, lat: float, lon: float, codigo_pais: str = None, pais_usuario: str = None,
+                             zona_horaria: str = None) -> dict:
+        """Obtiene la zona horaria y hora local basada en coordenadas y código de país (o en una zona ya conocida)."""
         try:
             # Determinar la zona horaria
-            if pais_usuario and pais_usuario.lower() in PAISES_INFO:
+            if zona_horaria:
+                timezone_str = zona_horaria
+            elif pais_usuario and pais_usuario.lower() in PAISES_INFO:
                 codigo_pais = PAISES_INFO[pais_usuario.lower()]['codigo']
                 logger.info(f"🌍 Usando código de país del usuario: {codigo_pais}")
                 
@@ -249,10 +1393,10 @@ class ChatbotClima:
                     timezone_str = ZONAS_HORARIAS_PAIS[codigo_pais][0]
                     logger.info(f"🌍 Usando zona horaria predefinida: {timezone_str}")
                 else:
-                    timezone_str = self.tf.timezone_at(lat=lat, lng=lon)
+                    timezone_str = self._zona_horaria_por_coordenadas(lat, lon)
                     logger.info(f"🌍 Zona horaria determinada por coordenadas: {timezone_str}")
             else:
-                timezone_str = self.tf.timezone_at(lat=lat, lng=lon)
+                timezone_str = self._zona_horaria_por_coordenadas(lat, lon)
                 logger.info(f"🌍 Zona horaria determinada por coordenadas: {timezone_str}")
 
             if not timezone_str:
@@ -305,23 +1449,53 @@ class ChatbotClima:
 
     """Chatbot for providing weather and time information."""
     
-    def __init__(self):
+    def __init__(self, cache: Optional[CacheCompartida] = None, almacen: Optional[AlmacenPersistente] = None,
+                 nlp_procesos: int = NLP_PROCESOS, contextos: Optional[CacheCompartida] = None):
         """Initialize the chatbot with configuration."""
         self.saludos = SALUDOS
         self.palabras_clima = PALABRAS_CLIMA
         self.palabras_hora = PALABRAS_HORA
+        self.palabras_pronostico = PALABRAS_PRONOSTICO
+        self.palabras_tendencia = PALABRAS_TENDENCIA
         self.paises_info = PAISES_INFO
         self.ciudades_especiales = CIUDADES_ESPECIALES
         self.tf = TimezoneFinder()
+        self.cache = cache if cache is not None else CacheCompartida()
+        self.almacen = almacen
+        # Las conversaciones van en su propio almacén acotado para no desalojar la cache de consultas
+        self.contextos = contextos if contextos is not None else CacheCompartida(
+            CONTEXTO_RUTA, CONTEXTO_MAX_SESIONES, CONTEXTO_TAMANO_SLOT
+        )
+        self.limitador = LimitadorCuota(self.cache)
+        self.historial = HistorialObservaciones()
+        self._local = threading.local()  # prioridad de las llamadas a la API de cada hilo
         
         # Configuración spaCy
         self.nlp = nlp  # Usamos el modelo cargado globalmente
         self.stop_words = STOP_WORDS_SPACY
-        self.puntuacion = set(punctuation)
+        self.puntuacion = set(punctuation) | {'¿', '¡'}
+        self.analisis_cache = CacheLRU(ANALISIS_CACHE_MAX_ENTRADAS)
+        self._generacion_analisis = 0  # última invalidación compartida aplicada en este worker
+        self._palabras_saludo = {self._eliminar_tildes(p) for p in SALUDOS}
+        self._palabras_costosas = {self._eliminar_tildes(p) for p in PALABRAS_CLIMA + PALABRAS_PRONOSTICO}
+        self._palabras_tendencia = {self._eliminar_tildes(p) for p in PALABRAS_TENDENCIA}
+        self._palabras_pronostico = {self._eliminar_tildes(p) for p in PALABRAS_PRONOSTICO}
+        self._palabras_dia_siguiente = {self._eliminar_tildes(p) for p in PALABRAS_DIA_SIGUIENTE}
+        self._palabras_parte_del_dia = {self._eliminar_tildes(p) for p in PALABRAS_PARTE_DEL_DIA}
+        self._palabras_hora = {'hora', 'horas'}
         
         self.weather_api_key = os.getenv('OPENWEATHER_API_KEY')
         self.geocoding_api_key = os.getenv('GEOCODING_API_KEY')
         
+        # Al final: los procesos del pool heredan el chatbot ya configurado
+        self.analizador_procesos = None
+        if nlp_procesos > 0:
+            try:
+                self.analizador_procesos = AnalizadorEnProcesos(self, nlp_procesos)
+                logger.info(f"🧠 Análisis NLP en {nlp_procesos} procesos")
+            except (ValueError, OSError) as e:
+                logger.warning(f"⚠️ No se pudo crear el pool NLP, se analiza en el hilo: {str(e)}")
+        
     def _limpiar_texto(self, texto: str) -> List[str]:
         """
         Limpia el texto eliminando stopwords y puntuación usando spaCy.
@@ -390,11 +1564,26 @@ class ChatbotClima:
         logger.info(f"🔵 Parámetros: {params}")
         
         for attempt in range(MAX_RETRIES):
+            # Rechazar de inmediato si no queda cuota en lugar de encolar la llamada
+            espera = self.limitador.consumir(endpoint, getattr(self._local, 'prioridad', 'interactiva'))
+            if espera > 0:
+                logger.warning(f"⏳ Cuota agotada para {endpoint}, disponible en {espera:.1f}s")
+                raise CuotaAgotadaError(espera)
+
             try:
                 response = requests.get(url, params=params, timeout=TIMEOUT)
                 
                 # Log response info
                 logger.info(f"🔵 Código de estado: {response.status_code}")
+
+                # Un 429 no se reintenta: reintentar solo consumiría más cuota
+                if response.status_code == 429:
+                    try:
+                        retry_after = float(response.headers.get('Retry-After', 60))
+                    except ValueError:
+                        retry_after = 60.0
+                    self.limitador.bloquear(retry_after)
+                    raise CuotaAgotadaError(retry_after, "La API devolvió 429 (límite de llamadas)")
                 
                 # Parse JSON response
                 data = response.json()
@@ -405,15 +1594,176 @@ class ChatbotClima:
                     
                 return data
                 
+            except CuotaAgotadaError:
+                raise
             except Exception as e:
                 logger.error(f"❌ Intento {attempt + 1} fallido: {str(e)}")
                 if attempt == MAX_RETRIES - 1:
                     raise WeatherAPIError(f"Error después de {MAX_RETRIES} intentos: {str(e)}")
                 time.sleep((attempt + 1) * 2)
 
+    @contextmanager
+    def prioridad_api(self, prioridad: str):
+        """Asigna la prioridad del limitador ('interactiva' o 'fondo') a las llamadas de este hilo."""
+        anterior = getattr(self._local, 'prioridad', 'interactiva')
+        self._local.prioridad = prioridad
+        try:
+            yield
+        finally:
+            self._local.prioridad = anterior
+
+    def precalentar(self, ubicaciones: List[str]) -> bool:
+        """
+        Carga en segundo plano geocoding, zona horaria y clima de varias ubicaciones.
+        
+        Las llamadas usan la prioridad 'fondo' del limitador, así que nunca consumen la
+        reserva de las consultas interactivas; si no hay cuota se espera y se reintenta.
+        La tarea se reclama en la cache compartida, de modo que solo hay un
+        precalentamiento en curso entre todos los workers, y su progreso queda ahí.
+        
+        Args:
+            ubicaciones: Países, capitales o ciudades a precalentar
+            
+        Returns:
+            False si ya hay un precalentamiento en curso en algún worker
+        """
+        trabajo = uuid.uuid4().hex
+        ahora = time.time()
+
+        def reclamar(actual: Optional[Dict]) -> Dict:
+            if actual and actual['en_curso'] and ahora - actual['actualizado'] < PRECALENTAR_SIN_LATIDO:
+                return actual
+            return {
+                'id': trabajo, 'pid': os.getpid(), 'en_curso': True, 'total': len(ubicaciones),
+                'completadas': 0, 'pospuestas': 0, 'errores': 0, 'detalles': [],
+                'inicio': ahora, 'actualizado': ahora, 'fin': None
+            }
+
+        if self.cache.actualizar('admin', 'precalentamiento', reclamar, ttl=PRECALENTAR_ESTADO_TTL)['id'] != trabajo:
+            return False
+        threading.Thread(target=self._precalentar, args=(trabajo, list(ubicaciones)),
+                         name='precalentamiento', daemon=True).start()
+        return True
+
+    def _avanzar_precalentamiento(self, trabajo: str, cambio: Callable[[Dict], None]) -> bool:
+        """
+        Aplica ``cambio`` al estado compartido del precalentamiento y renueva su latido.
+        
+        Returns:
+            False si el estado ya no pertenece a ``trabajo`` (otro worker lo reemplazó)
+        """
+        vigente = False
+
+        def aplicar(actual: Optional[Dict]) -> Optional[Dict]:
+            nonlocal vigente
+            if not actual or actual.get('id') != trabajo:
+                return actual
+            vigente = True
+            cambio(actual)
+            actual['actualizado'] = time.time()
+            return actual
+
+        self.cache.actualizar('admin', 'precalentamiento', aplicar, ttl=PRECALENTAR_ESTADO_TTL)
+        return vigente
+
+    def _precalentar(self, trabajo: str, ubicaciones: List[str]) -> None:
+        """Cuerpo del hilo de ``precalentar``."""
+        logger.info(f"🔥 Precalentando la cache con {len(ubicaciones)} ubicaciones")
+
+        def anotar(tipo: str, ubicacion: str, error: Optional[str] = None) -> Callable[[Dict], None]:
+            def cambio(estado: Dict) -> None:
+                estado[tipo] += 1
+                # Solo unos pocos detalles, para que el estado quepa en un slot de la cache
+                if len(estado['detalles']) < PRECALENTAR_MAX_DETALLES:
+                    detalle = {'ubicacion': ubicacion[:64], 'tipo': tipo}
+                    if error:
+                        detalle['error'] = error[:120]
+                    estado['detalles'].append(detalle)
+            return cambio
+
+        with self.prioridad_api('fondo'):
+            for ubicacion in ubicaciones:
+                for intento in range(PRECALENTAR_MAX_INTENTOS):
+                    # Renovar el latido antes de cada intento (las esperas por cuota son largas)
+                    if not self._avanzar_precalentamiento(trabajo, lambda estado: None):
+                        logger.warning("⚠️ Precalentamiento reemplazado por otro worker; se detiene")
+                        return
+                    try:
+                        clima = self.obtener_clima_actual(ubicacion)
+                    except CuotaAgotadaError as e:
+                        time.sleep(min(e.retry_after, PRECALENTAR_ESPERA_MAX))
+                        continue
+                    if clima.get('stale'):
+                        # Sin cuota de fondo se sirvió el dato caducado: esperar a que se
+                        # recupere la reserva interactiva y volver a intentar
+                        time.sleep(min(CUOTA_RESERVA_INTERACTIVA * 60, PRECALENTAR_ESPERA_MAX))
+                        continue
+                    if 'error' in clima:
+                        self._avanzar_precalentamiento(trabajo, anotar('errores', ubicacion, clima['error']))
+                    else:
+                        self._avanzar_precalentamiento(trabajo, lambda estado: estado.update(
+                            completadas=estado['completadas'] + 1))
+                    break
+                else:
+                    self._avanzar_precalentamiento(trabajo, anotar('pospuestas', ubicacion))
+
+        def terminar(estado: Dict) -> None:
+            estado['en_curso'] = False
+            estado['fin'] = time.time()
+
+        self._avanzar_precalentamiento(trabajo, terminar)
+        estado = self.estado_precalentamiento()
+        logger.info(
+            f"🔥 Precalentamiento terminado: {estado.get('completadas')}/{estado.get('total')} ubicaciones, "
+            f"{estado.get('pospuestas')} pospuestas, {estado.get('errores')} con error"
+        )
+
+    def estado_precalentamiento(self) -> Dict[str, Any]:
+        """Progreso del último precalentamiento, lanzado desde cualquier worker."""
+        estado = self.cache.obtener('admin', 'precalentamiento')
+        if not estado:
+            return {'en_curso': False}
+        if estado['en_curso'] and time.time() - estado['actualizado'] >= PRECALENTAR_SIN_LATIDO:
+            # El worker que lo ejecutaba terminó sin cerrarlo (reinicio, timeout...)
+            estado['en_curso'] = False
+            estado['interrumpido'] = True
+        return estado
+
+    def _leer_cache(self, espacio: str, clave: str) -> Any:
+        """Busca en la cache compartida y, si falla, en la cache persistente."""
+        valor = self.cache.obtener(espacio, clave)
+        if valor is None and self.almacen is not None:
+            valor, ttl_restante = self.almacen.obtener(espacio, clave)
+            if valor is not None:
+                self.cache.guardar(espacio, clave, valor, ttl_restante)
+        return valor
+
+    def _escribir_cache(self, espacio: str, clave: str, valor: Any, ttl: Optional[float] = None) -> None:
+        """Guarda en la cache compartida y, para los tipos persistentes, también en disco."""
+        ttl = ttl if ttl is not None else CACHE_TTL[espacio]
+        self.cache.guardar(espacio, clave, valor, ttl)
+        if self.almacen is not None:
+            self.almacen.guardar(espacio, clave, valor, ttl)
+
+    def _zona_horaria_por_coordenadas(self, lat: float, lon: float) -> Optional[str]:
+        """Resuelve la zona horaria de unas coordenadas, usando la cache compartida."""
+        clave = f"{lat:.3f},{lon:.3f}"
+        timezone_str = self._leer_cache('zona_horaria', clave)
+        if timezone_str is None:
+            timezone_str = self.tf.timezone_at(lat=lat, lng=lon)
+            if timezone_str:
+                self._escribir_cache('zona_horaria', clave, timezone_str)
+        return timezone_str
+
     def obtener_coordenadas(self, ubicacion: str, codigo_pais: str = None) -> Tuple[Optional[str], Optional[float], Optional[float], Optional[str]]:
         """Obtiene las coordenadas de una ubicación. Si se provee código de país, lo usa para mayor precisión."""
         try:
+            clave = f"{ubicacion.lower().strip()}|{(codigo_pais or '').upper()}"
+            cacheado = self._leer_cache('geocoding', clave)
+            if cacheado is not None:
+                logger.info(f"🗄️ Coordenadas en cache para: {ubicacion}")
+                return tuple(cacheado)
+
             params = {
                 'q': ubicacion if not codigo_pais else f"{ubicacion},{codigo_pais}",
                 'limit': 1
@@ -421,13 +1771,18 @@ class ChatbotClima:
             data = self._make_api_request(GEOCODING_ENDPOINT, params)
             if data and len(data) > 0:
                 location = data[0]
-                return (
+                resultado = (
                     location.get('name'),
                     location.get('lat'),
                     location.get('lon'),
                     location.get('country')
                 )
+                self._escribir_cache('geocoding', clave, list(resultado))
+                return resultado
+            self._escribir_cache('geocoding', clave, [None, None, None, None], CACHE_TTL['geocoding_vacio'])
             return None, None, None, None
+        except CuotaAgotadaError:
+            raise
         except Exception as e:
             logger.error(f"❌ Error al obtener coordenadas: {str(e)}")
             return None, None, None, None
@@ -443,27 +1798,51 @@ class ChatbotClima:
                 'lang': 'es'
             }
             
-            weather_data = self._make_api_request(WEATHER_ENDPOINT, params)
-            
+            clave = f"{lat:.2f},{lon:.2f}"
+            obsoleto = False
+            weather_data = self._leer_cache('clima', clave)
+            if weather_data is None:
+                try:
+                    weather_data = self._make_api_request(WEATHER_ENDPOINT, params)
+                except CuotaAgotadaError:
+                    # Sin cuota: servir el último dato conocido aunque haya caducado
+                    weather_data = self.cache.obtener('clima', clave, incluir_expirados=True)
+                    if weather_data is None:
+                        raise
+                    logger.warning(f"⏳ Cuota agotada, usando clima obsoleto para {clave}")
+                    obsoleto = True
+                else:
+                    if weather_data:
+                        self._escribir_cache('clima', clave, weather_data)
+            
             if not weather_data:
                 raise WeatherAPIError("No se pudieron obtener datos del clima")
                 
             # Get location name through reverse geocoding
-            geocoding_params = {
-                'lat': lat,
-                'lon': lon,
-                'limit': 1
-            }
-            
-            location_data = self._make_api_request(REVERSE_GEOCODING_ENDPOINT, geocoding_params)
-            
-            # Get location name
-            if location_data and len(location_data) > 0:
-                nombre_ubicacion = location_data[0].get('name', 'Desconocido')
-                codigo_pais = location_data[0].get('country', '')
+            ubicacion_cacheada = self._leer_cache('reverse', clave)
+            if ubicacion_cacheada is not None:
+                nombre_ubicacion, codigo_pais = ubicacion_cacheada
             else:
-                nombre_ubicacion = "Ubicación"
-                codigo_pais = ""
+                geocoding_params = {
+                    'lat': lat,
+                    'lon': lon,
+                    'limit': 1
+                }
+                
+                try:
+                    location_data = self._make_api_request(REVERSE_GEOCODING_ENDPOINT, geocoding_params)
+                except CuotaAgotadaError:
+                    # El nombre no es imprescindible: seguir con el nombre genérico
+                    location_data = None
+                
+                # Get location name
+                if location_data and len(location_data) > 0:
+                    nombre_ubicacion = location_data[0].get('name', 'Desconocido')
+                    codigo_pais = location_data[0].get('country', '')
+                    self._escribir_cache('reverse', clave, [nombre_ubicacion, codigo_pais])
+                else:
+                    nombre_ubicacion = "Ubicación"
+                    codigo_pais = ""
                 
             # Get timezone info
             timezone_info = self.obtener_zona_horaria(lat, lon, codigo_pais)
@@ -501,7 +1880,7 @@ class ChatbotClima:
                 fecha_local = ""
                 hora_local = ""
 
-            return {
+            clima = {
                 'location': f"{nombre_ubicacion}{', ' + codigo_pais if codigo_pais else ''}",
                 'coordinates': {'lat': lat, 'lon': lon},
                 'temp': round(main.get('temp'), 1),
@@ -516,39 +1895,69 @@ class ChatbotClima:
                 'weekday': timezone_info.get('weekday', ''),
                 'date': fecha_local  # <-- Día completo según la zona horaria correspondiente
             }
+            if obsoleto:
+                clima['stale'] = True
+            # Registrar la medición para /tendencias (una sola vez por 'dt' de OpenWeather)
+            self.historial.registrar(clave, clima['location'], weather_data.get('dt') or time.time(), clima)
+            return clima
             
+        except CuotaAgotadaError:
+            raise
         except Exception as e:
             logger.error(f"Error obteniendo clima: {str(e)}")
             raise WeatherAPIError(f"Error al obtener el clima: {str(e)}")
 
+    def _resolver_ubicacion(self, ubicacion: str) -> Tuple[Optional[str], Optional[float], Optional[float], Optional[str]]:
+        """
+        Resuelve una ubicación a coordenadas usando primero el diccionario de países y
+        ciudades conocidas y después la API de geocoding (con cache).
+
+        Args:
+            ubicacion: Nombre de país, capital o ciudad
+
+        Returns:
+            Tupla (nombre, lat, lon, código de país); con None si no se encuentra
+        """
+        ubicacion_lower = ubicacion.lower().strip()
+        pais_encontrado = None
+        for pais, info in PAISES_INFO.items():
+            if ubicacion_lower == pais or ubicacion_lower in info['variantes']:
+                pais_encontrado = pais
+                break
+        if pais_encontrado:
+            capital = PAISES_INFO[pais_encontrado]['capital']
+            codigo_pais = PAISES_INFO[pais_encontrado]['codigo']
+            logger.info(f"📍 Usando capital {capital} para país {pais_encontrado} ({codigo_pais})")
+            return self.obtener_coordenadas(capital, codigo_pais)
+        if ubicacion_lower in CIUDADES_POR_PAIS:
+            capital = CIUDADES_POR_PAIS[ubicacion_lower]
+            logger.info(f"📍 Usando capital {capital} para país {ubicacion_lower}")
+            return self.obtener_coordenadas(capital)
+        if ubicacion_lower in CIUDADES_ESPECIALES:
+            ciudad, codigo_pais = CIUDADES_ESPECIALES[ubicacion_lower].split(',')
+            return self.obtener_coordenadas(ciudad, codigo_pais)
+
+        nombre_ciudad, lat, lon, codigo_pais_resp = self.obtener_coordenadas(ubicacion)
+        # Si no se encuentra, intentar con las capitales conocidas
+        if not all([lat, lon]):
+            for pais, info in PAISES_INFO.items():
+                if ubicacion_lower == info['capital'].lower():
+                    nombre_ciudad, lat, lon, codigo_pais_resp = self.obtener_coordenadas(info['capital'], info['codigo'])
+                    if all([lat, lon]):
+                        break
+        return nombre_ciudad, lat, lon, codigo_pais_resp
+
     def obtener_clima_actual(self, ubicacion: str) -> dict:
         """Obtiene el clima actual para una ubicación o país y devuelve un dict estructurado."""
         try:
-            ubicacion_lower = ubicacion.lower().strip()
-            pais_encontrado = None
-            for pais, info in PAISES_INFO.items():
-                if ubicacion_lower == pais or ubicacion_lower in info['variantes']:
-                    pais_encontrado = pais
-                    break
-            if pais_encontrado:
-                capital = PAISES_INFO[pais_encontrado]['capital']
-                codigo_pais = PAISES_INFO[pais_encontrado]['codigo']
-                logger.info(f"📍 Usando capital {capital} para país {pais_encontrado} ({codigo_pais})")
-                nombre_ciudad, lat, lon, codigo_pais_resp = self.obtener_coordenadas(capital, codigo_pais)
-            else:
-                nombre_ciudad, lat, lon, codigo_pais_resp = self.obtener_coordenadas(ubicacion)
-                # Si no se encuentra, intentar variantes de país
-                if not all([lat, lon]):
-                    for pais, info in PAISES_INFO.items():
-                        if ubicacion_lower == pais or ubicacion_lower in info['variantes'] or ubicacion_lower == info['capital'].lower():
-                            nombre_ciudad, lat, lon, codigo_pais_resp = self.obtener_coordenadas(info['capital'], info['codigo'])
-                            if all([lat, lon]):
-                                break
+            nombre_ciudad, lat, lon, codigo_pais_resp = self._resolver_ubicacion(ubicacion)
             if not all([lat, lon]):
                 logger.warning(f"No pude encontrar la ubicación: {ubicacion}")
                 return {'error': f"No pude encontrar la ubicación: {ubicacion}"}
             clima_data = self.obtener_clima_por_coordenadas(lat, lon)
             return clima_data
+        except CuotaAgotadaError:
+            raise
         except WeatherAPIError as e:
             logger.error(f"Error en API del clima: {str(e)}")
             return {'error': f"Error al obtener el clima: {str(e)}"}
@@ -556,7 +1965,218 @@ class ChatbotClima:
             logger.error(f"Error inesperado: {str(e)}")
             return {'error': "Lo siento, ha ocurrido un error al obtener el clima."}
 
-    @lru_cache(maxsize=128)
+    def obtener_pronostico_por_coordenadas(self, lat: float, lon: float) -> Dict:
+        """
+        Obtiene el pronóstico diario (hasta 6 días locales) usando las coordenadas.
+        
+        Se pide el pronóstico de 5 días cada 3 horas una vez por ubicación y se guarda ya
+        agregado por día, que es lo que cabe en un slot de la cache compartida.
+        """
+        try:
+            clave = f"{lat:.2f},{lon:.2f}"
+            obsoleto = False
+            pronostico = self._leer_cache('pronostico', clave)
+            if pronostico is None:
+                # Sin 'lang': las condiciones llegan en inglés y se traducen con CONDICIONES_TRADUCIDAS
+                params = {'lat': lat, 'lon': lon, 'units': 'metric'}
+                try:
+                    forecast_data = self._make_api_request(FORECAST_ENDPOINT, params)
+                except CuotaAgotadaError:
+                    pronostico = self.cache.obtener('pronostico', clave, incluir_expirados=True)
+                    if pronostico is None:
+                        raise
+                    logger.warning(f"⏳ Cuota agotada, usando pronóstico obsoleto para {clave}")
+                    obsoleto = True
+                else:
+                    if not forecast_data or not forecast_data.get('list'):
+                        raise WeatherAPIError("No se pudieron obtener datos del pronóstico")
+                    ciudad = forecast_data.get('city', {})
+                    pronostico = {
+                        'location': ciudad.get('name') or "Ubicación",
+                        'country': ciudad.get('country', ''),
+                        'days': self._agregar_pronostico_diario(forecast_data['list'], ciudad.get('timezone', 0))
+                    }
+                    self._escribir_cache('pronostico', clave, pronostico)
+
+            respuesta = {
+                'type': 'forecast',
+                'location': f"{pronostico['location']}{', ' + pronostico['country'] if pronostico['country'] else ''}",
+                'coordinates': {'lat': lat, 'lon': lon},
+                'days': pronostico['days']
+            }
+            if obsoleto:
+                respuesta['stale'] = True
+            return respuesta
+
+        except WeatherAPIError:
+            raise
+        except Exception as e:
+            logger.error(f"Error obteniendo pronóstico: {str(e)}")
+            raise WeatherAPIError(f"Error al obtener el pronóstico: {str(e)}")
+
+    @staticmethod
+    def _agregar_pronostico_diario(intervalos: List[Dict], desplazamiento: int) -> List[Dict]:
+        """
+        Agrega los intervalos de 3 horas del pronóstico por día local con operaciones de NumPy.
+        
+        Args:
+            intervalos: Lista 'list' de la respuesta de FORECAST_ENDPOINT (en orden cronológico)
+            desplazamiento: Segundos respecto a UTC de la ubicación ('city.timezone')
+            
+        Returns:
+            Lista de días con temperatura mínima y máxima, probabilidad de precipitación (%),
+            lluvia acumulada (mm) y la condición e icono más frecuentes
+        """
+        dt = np.array([i['dt'] for i in intervalos], dtype=np.int64)
+        temp_min = np.array([i['main']['temp_min'] for i in intervalos], dtype=np.float64)
+        temp_max = np.array([i['main']['temp_max'] for i in intervalos], dtype=np.float64)
+        pop = np.array([i.get('pop', 0) for i in intervalos], dtype=np.float64)
+        lluvia = np.array([i.get('rain', {}).get('3h', 0) + i.get('snow', {}).get('3h', 0) for i in intervalos],
+                          dtype=np.float64)
+        condiciones, condicion = np.unique([i['weather'][0]['main'].lower() for i in intervalos], return_inverse=True)
+        iconos, icono = np.unique([i['weather'][0]['icon'][:2] for i in intervalos], return_inverse=True)
+
+        # Día local de cada intervalo y posición donde empieza cada día
+        dia = (dt + desplazamiento) // 86400
+        nuevo_dia = np.empty(len(dia), dtype=bool)
+        nuevo_dia[0] = True
+        nuevo_dia[1:] = dia[1:] != dia[:-1]
+        inicios = np.flatnonzero(nuevo_dia)
+        grupo = np.cumsum(nuevo_dia) - 1
+        dias = len(inicios)
+
+        minimas = np.minimum.reduceat(temp_min, inicios)
+        maximas = np.maximum.reduceat(temp_max, inicios)
+        probabilidades = np.maximum.reduceat(pop, inicios)
+        acumulado = np.add.reduceat(lluvia, inicios)
+        # Moda por día: conteo conjunto (día, valor) y el valor más repetido de cada fila
+        condicion_dominante = np.bincount(grupo * len(condiciones) + condicion,
+                                          minlength=dias * len(condiciones)).reshape(dias, -1).argmax(axis=1)
+        icono_dominante = np.bincount(grupo * len(iconos) + icono,
+                                      minlength=dias * len(iconos)).reshape(dias, -1).argmax(axis=1)
+
+        resultado = []
+        for d in range(dias):
+            fecha = datetime.fromtimestamp(int(dia[inicios[d]]) * 86400, tz=pytz.utc).date()
+            nombre_condicion = str(condiciones[condicion_dominante[d]])
+            resultado.append({
+                'date': fecha.isoformat(),
+                'weekday': DIAS_SEMANA[fecha.weekday()],
+                'temp_min': round(float(minimas[d]), 1),
+                'temp_max': round(float(maximas[d]), 1),
+                'pop': int(round(float(probabilidades[d]) * 100)),
+                'rain_mm': round(float(acumulado[d]), 1),
+                'description': CONDICIONES_TRADUCIDAS.get(nombre_condicion, nombre_condicion.capitalize()),
+                'icon': WEATHER_ICONS.get(str(iconos[icono_dominante[d]]), '🌤️')
+            })
+        return resultado
+
+    def obtener_pronostico(self, ubicacion: str) -> dict:
+        """Obtiene el pronóstico diario para una ubicación o país y devuelve un dict estructurado."""
+        try:
+            nombre_ciudad, lat, lon, codigo_pais_resp = self._resolver_ubicacion(ubicacion)
+            if not all([lat, lon]):
+                logger.warning(f"No pude encontrar la ubicación: {ubicacion}")
+                return {'error': f"No pude encontrar la ubicación: {ubicacion}"}
+            return self.obtener_pronostico_por_coordenadas(lat, lon)
+        except CuotaAgotadaError:
+            raise
+        except WeatherAPIError as e:
+            logger.error(f"Error en API del pronóstico: {str(e)}")
+            return {'error': f"Error al obtener el pronóstico: {str(e)}"}
+        except Exception as e:
+            logger.error(f"Error inesperado: {str(e)}")
+            return {'error': "Lo siento, ha ocurrido un error al obtener el pronóstico."}
+
+    def obtener_tendencias_por_coordenadas(self, lat: float, lon: float, horas: float = 24) -> dict:
+        """Resume el clima registrado en las últimas ``horas`` para unas coordenadas, sin consultar la API."""
+        resumen = self.historial.resumen(f"{lat:.2f},{lon:.2f}", horas)
+        if resumen is None:
+            return {'error': f"Aún no hay observaciones de esa ubicación en las últimas {horas:g} horas"}
+        return {'type': 'trend', 'horas': horas, 'coordinates': {'lat': lat, 'lon': lon}, **resumen}
+
+    def obtener_tendencias(self, ubicacion: str, horas: float = 24) -> dict:
+        """Resume el clima registrado en las últimas ``horas`` para una ubicación o país."""
+        nombre_ciudad, lat, lon, codigo_pais_resp = self._resolver_ubicacion(ubicacion)
+        if not all([lat, lon]):
+            logger.warning(f"No pude encontrar la ubicación: {ubicacion}")
+            return {'error': f"No pude encontrar la ubicación: {ubicacion}"}
+        tendencias = self.obtener_tendencias_por_coordenadas(lat, lon, horas)
+        if 'error' in tendencias:
+            return {'error': f"Aún no hay observaciones de {ubicacion} en las últimas {horas:g} horas"}
+        return tendencias
+
+    @staticmethod
+    def _describir_tendencia(tendencias: dict) -> str:
+        """Frase con la evolución de la temperatura para responder en el chat."""
+        cambio = tendencias['cambio']['temp']
+        if cambio >= 0.1:
+            evolucion = f"ha subido {cambio:.1f}°C"
+        elif cambio <= -0.1:
+            evolucion = f"ha bajado {-cambio:.1f}°C"
+        else:
+            evolucion = "se ha mantenido estable"
+        return (
+            f"En {tendencias['location']} la temperatura {evolucion} en las últimas {tendencias['horas']:g} horas "
+            f"(mínima {tendencias['min']['temp']:.1f}°C, máxima {tendencias['max']['temp']:.1f}°C, "
+            f"{tendencias['observaciones']} observaciones)."
+        )
+
+    def obtener_clima_multiple(self, ubicaciones: List[str]) -> List[Dict]:
+        """
+        Obtiene el clima actual de varias ubicaciones en una sola operación.
+
+        Las ubicaciones se resuelven con el diccionario de países y la cache; las
+        coordenadas repetidas se consultan una sola vez y las que faltan en cache se
+        piden a la API de forma concurrente (sujetas al limitador de cuota).
+
+        Args:
+            ubicaciones: Lista de países, capitales o ciudades
+
+        Returns:
+            Lista en el mismo orden que ``ubicaciones`` con el resultado de
+            ``obtener_clima_por_coordenadas`` o un dict con 'error'
+        """
+        def resolver(ubicacion: str):
+            try:
+                return self._resolver_ubicacion(ubicacion)
+            except CuotaAgotadaError as e:
+                return e
+            except Exception as e:
+                logger.error(f"❌ Error al resolver {ubicacion}: {str(e)}")
+                return None, None, None, None
+
+        def consultar(lat: float, lon: float) -> Dict:
+            try:
+                return self.obtener_clima_por_coordenadas(lat, lon)
+            except CuotaAgotadaError as e:
+                return {'error': 'Servicio ocupado, inténtalo de nuevo más tarde', 'retry_after': math.ceil(e.retry_after)}
+            except WeatherAPIError as e:
+                return {'error': f"Error al obtener el clima: {str(e)}"}
+
+        with ThreadPoolExecutor(max_workers=CLIMA_MULTIPLE_CONCURRENCIA) as executor:
+            resueltas = list(executor.map(resolver, ubicaciones))
+
+            # Agrupar por coordenadas para no consultar dos veces el mismo punto
+            coordenadas = {}
+            for resuelta in resueltas:
+                if isinstance(resuelta, tuple) and all(resuelta[1:3]):
+                    coordenadas.setdefault(f"{resuelta[1]:.2f},{resuelta[2]:.2f}", resuelta[1:3])
+            futuros = {clave: executor.submit(consultar, lat, lon) for clave, (lat, lon) in coordenadas.items()}
+            climas = {clave: futuro.result() for clave, futuro in futuros.items()}
+
+        resultados = []
+        for ubicacion, resuelta in zip(ubicaciones, resueltas):
+            if isinstance(resuelta, CuotaAgotadaError):
+                resultados.append({'error': 'Servicio ocupado, inténtalo de nuevo más tarde',
+                                   'retry_after': math.ceil(resuelta.retry_after)})
+            elif not all(resuelta[1:3]):
+                resultados.append({'error': f"No pude encontrar la ubicación: {ubicacion}"})
+            else:
+                resultados.append(climas[f"{resuelta[1]:.2f},{resuelta[2]:.2f}"])
+        logger.info(f"🌍 Clima múltiple: {len(ubicaciones)} ubicaciones, {len(coordenadas)} coordenadas distintas")
+        return resultados
+
     def obtener_hora_ciudad(self, ciudad: str) -> dict:
         """Obtiene la hora actual en una ciudad específica."""
         try:
@@ -568,53 +2188,65 @@ class ChatbotClima:
             else:
                 codigo_pais = None
 
-            # Obtener coordenadas y zona horaria
-            nombre_ciudad, lat, lon, api_codigo_pais = self.obtener_coordenadas(ciudad)
-            
-            if not all([lat, lon]):
-                return {'error': f"No pude encontrar la ubicación de {ciudad}"}
+            if codigo_pais in ZONAS_HORARIAS_PAIS:
+                # País con zona horaria conocida: se resuelve sin llamar a la API
+                nombre_ciudad = ciudad
+                timezone_info = self.obtener_zona_horaria(None, None, codigo_pais, pais_usuario=ciudad_lower)
+            else:
+                # Obtener coordenadas y zona horaria
+                nombre_ciudad, lat, lon, api_codigo_pais = self.obtener_coordenadas(ciudad)
                 
-            # Obtener zona horaria
-            timezone_info = self.obtener_zona_horaria(lat, lon, api_codigo_pais, pais_usuario=ciudad_lower)
+                if not all([lat, lon]):
+                    return {'error': f"No pude encontrar la ubicación de {ciudad}"}
+                    
+                # Obtener zona horaria
+                timezone_info = self.obtener_zona_horaria(lat, lon, api_codigo_pais, pais_usuario=ciudad_lower)
             
             if 'error' in timezone_info:
                 return {'error': f"Error al obtener la hora para {ciudad}: {timezone_info['error']}"}
                 
             # Formatear respuesta como objeto estructurado
             ubicacion = f"{nombre_ciudad}, {codigo_pais}" if codigo_pais else nombre_ciudad
+            return self._respuesta_hora(ubicacion, timezone_info)
             
-            # Get offset for display
-            tz = pytz.timezone(timezone_info['timezone'])
-            now = datetime.now(tz)
-            offset = now.strftime('%z')
-            offset_str = f"GMT{offset[:3]}:{offset[3:]}"
-            
-            return {
-                'type': 'time',
-                'location': ubicacion,
-                'timezone': timezone_info['timezone'],
-                'timezone_display': offset_str,
-                'time': timezone_info['time'],
-                'time_12': timezone_info['time_12'],
-                'moment': timezone_info['moment'],
-                'weekday': timezone_info['weekday']
-            }
-            
+        except CuotaAgotadaError:
+            raise
         except Exception as e:
             logger.error(f"Error al obtener hora: {str(e)}")
             return {'error': f"Lo siento, ocurrió un error al obtener la hora para {ciudad}"}
 
-    def extraer_entidades(self, texto: str) -> Dict[str, List[str]]:
+    def _respuesta_hora(self, ubicacion: str, timezone_info: dict) -> dict:
+        """Construye la respuesta de hora a partir del resultado de ``obtener_zona_horaria``."""
+        # Get offset for display
+        tz = pytz.timezone(timezone_info['timezone'])
+        now = datetime.now(tz)
+        offset = now.strftime('%z')
+        offset_str = f"GMT{offset[:3]}:{offset[3:]}"
+        
+        return {
+            'type': 'time',
+            'location': ubicacion,
+            'timezone': timezone_info['timezone'],
+            'timezone_display': offset_str,
+            'time': timezone_info['time'],
+            'time_12': timezone_info['time_12'],
+            'moment': timezone_info['moment'],
+            'weekday': timezone_info['weekday']
+        }
+
+    def extraer_entidades(self, texto: str, doc=None) -> Dict[str, List[str]]:
         """
         Extrae entidades del texto usando spaCy.
         
         Args:
             texto: Texto del que extraer entidades
+            doc: Texto ya procesado por spaCy (opcional)
             
         Returns:
             Diccionario con las entidades encontradas por tipo
         """
-        doc = self.nlp(texto)
+        if doc is None:
+            doc = self.nlp(texto)
         entidades = {
             'LOC': [],  # Ubicaciones
             'GPE': [],  # Países, ciudades, estados
@@ -655,12 +2287,294 @@ class ChatbotClima:
         
         return entidades
 
-    def procesar_mensaje(self, mensaje: str) -> str:
+    def _forma_canonica(self, mensaje: str) -> str:
+        """Normaliza mayúsculas, tildes, puntuación y espacios para reconocer mensajes equivalentes."""
+        texto = ''.join(' ' if c in self.puntuacion else c for c in self._eliminar_tildes(mensaje))
+        return ' '.join(texto.split())
+
+    def clasificar_costo(self, mensaje: Any, sesion: Optional[str] = None) -> str:
+        """
+        Estima, sin spaCy ni red, cuánto costará atender un mensaje de /chat.
+        
+        La hora solo es barata si se resuelve sin llamar a la API: zona horaria conocida
+        del país, geocoding ya cacheado o zona horaria guardada en la conversación.
+        
+        Args:
+            mensaje: Campo 'mensaje' de la solicitud
+            sesion: Identificador de la conversación, para las preguntas de seguimiento
+            
+        Returns:
+            'costosa' si probablemente consulte la API; 'barata' para saludos, tendencias,
+            la hora resuelta sin red y el texto de ayuda
+        """
+        if not isinstance(mensaje, str):
+            return 'barata'
+        mensaje = mensaje.strip()
+        if mensaje.startswith('@hora:'):
+            return 'barata' if self._hora_sin_red(mensaje[len('@hora:'):]) else 'costosa'
+        if mensaje.startswith(('@clima:', '@pronostico:', '@coordenadas:')):
+            return 'costosa'
+
+        # Si el mensaje ya se analizó, usar su intención y ubicación; si no, palabras clave
+        # en el mismo orden que el análisis (un saludo o una tendencia no consultan la API)
+        self._sincronizar_analisis()
+        canonica = self._forma_canonica(mensaje)
+        analisis = self.analisis_cache.consultar(canonica)
+        if analisis is not None:
+            intencion, ubicacion = analisis['intencion'], analisis['ubicacion']
+        else:
+            palabras = set(canonica.split())
+            ubicacion = None
+            if palabras & self._palabras_saludo:
+                intencion = 'saludo'
+            elif palabras & self._palabras_tendencia:
+                intencion = 'tendencia'
+            elif palabras & self._palabras_costosas or self._pide_pronostico(canonica.split()):
+                intencion = 'clima'
+            elif palabras & self._palabras_hora:
+                intencion = 'hora'
+            else:
+                intencion = None
+
+        contexto = None
+        if not ubicacion and intencion in (None, 'hora'):
+            contexto = self.obtener_contexto(sesion)
+            if contexto and intencion is None and self._es_seguimiento(mensaje):
+                intencion = contexto.get('intencion')
+        if intencion in ('clima', 'pronostico'):
+            return 'costosa'
+        if intencion != 'hora':
+            return 'barata'
+
+        if ubicacion:
+            return 'barata' if self._hora_sin_red(ubicacion) else 'costosa'
+        if analisis is None and not self._es_seguimiento(mensaje):
+            return 'costosa'  # la ubicación solo se conoce tras analizar el mensaje
+        if contexto:
+            if contexto.get('timezone') or contexto.get('lat') is not None:
+                return 'barata'
+            return 'barata' if self._hora_sin_red(contexto['ubicacion']) else 'costosa'
+        return 'barata' if self._hora_sin_red('aquí') else 'costosa'
+
+    def _pide_pronostico(self, palabras: List[str]) -> bool:
+        """
+        Indica si unas palabras (en minúsculas y sin tildes, en orden) piden un pronóstico.
+        
+        "pronóstico" basta por sí sola; "mañana" solo cuando se refiere al día siguiente
+        ("¿y mañana?", "clima mañana en Lima"), no a la parte del día ("esta mañana").
+        """
+        for i, palabra in enumerate(palabras):
+            if palabra in self._palabras_pronostico:
+                return True
+            if palabra in self._palabras_dia_siguiente and (
+                    i == 0 or palabras[i - 1] not in self._palabras_parte_del_dia):
+                return True
+        return False
+
+    def _hora_sin_red(self, ubicacion: str) -> bool:
+        """Indica si ``obtener_hora_ciudad`` puede resolver la ubicación sin llamar a la API."""
+        ubicacion = ubicacion.strip().lower()
+        info = PAISES_INFO.get(ubicacion)
+        if info and info['codigo'] in ZONAS_HORARIAS_PAIS:
+            return True
+        clave = f"{(info['capital'] if info else ubicacion).lower().strip()}|"
+        if self.cache.contiene('geocoding', clave):
+            return True
+        return self.almacen is not None and self.almacen.obtener('geocoding', clave)[0] is not None
+
+    def analizar_mensaje(self, mensaje: str) -> Dict[str, Any]:
+        """
+        Analiza el mensaje con spaCy para detectar la intención y la ubicación, sin consultar la API.
+        
+        El resultado se memoriza por la forma canónica del mensaje, de modo que variantes
+        como "clima en madrid" y "¿Clima en Madrid?" solo pasan una vez por spaCy.
+        
+        Args:
+            mensaje: Mensaje del usuario
+            
+        Returns:
+            Diccionario con 'intencion' ('saludo', 'clima', 'pronostico', 'tendencia', 'hora' o None), 'ubicacion'
+            (texto o None) y 'similitudes' (palabras clave reconocidas)
+        """
+        self._sincronizar_analisis()
+        clave = self._forma_canonica(mensaje)
+        analisis = self.analisis_cache.obtener(clave)
+        if analisis is None:
+            if self.analizador_procesos is not None:
+                try:
+                    analisis = self.analizador_procesos.analizar(mensaje)
+                except Exception as e:
+                    logger.warning(f"⚠️ Falló el análisis en el pool NLP, se analiza en el hilo: {str(e)}")
+            if analisis is None:
+                analisis = self._analizar_con_nlp(mensaje)
+            # El NER depende de mayúsculas: si no encontró ubicación para una consulta
+            # de clima u hora, otra variante del mismo mensaje podría encontrarla
+            if analisis['ubicacion'] or analisis['intencion'] not in ('clima', 'pronostico', 'tendencia', 'hora'):
+                self.analisis_cache.guardar(clave, analisis)
+        return dict(analisis)
+
+    def invalidar_analisis(self, patron: str) -> int:
+        """
+        Invalida en todos los workers los análisis memorizados cuya clave 'analisis:<mensaje>'
+        coincide con un patrón fnmatch.
+        
+        El patrón se publica en el espacio protegido 'admin' de la cache compartida y cada
+        worker lo aplica a su cache de análisis en su siguiente mensaje.
+        
+        Returns:
+            Entradas eliminadas en este worker
+        """
+        def publicar(actual: Optional[Dict]) -> Dict:
+            generacion = (actual or {}).get('generacion', 0) + 1
+            patrones = ((actual or {}).get('patrones', []) + [[generacion, patron]])[-ANALISIS_INVALIDACIONES_MAX:]
+            # Si los patrones no caben en un slot, los workers vaciarán toda su cache de análisis
+            if len(json.dumps(patrones, ensure_ascii=False)) > self.cache.tamano_slot // 2:
+                patrones = []
+            return {'generacion': generacion, 'patrones': patrones}
+
+        self.cache.actualizar('admin', 'invalidaciones_analisis', publicar, ttl=ANALISIS_INVALIDACIONES_TTL)
+        return self._sincronizar_analisis()
+
+    def _sincronizar_analisis(self) -> int:
+        """
+        Aplica a la cache de análisis de este worker las invalidaciones publicadas en la
+        cache compartida. Devuelve cuántas entradas eliminó.
+        """
+        estado = self.cache.obtener('admin', 'invalidaciones_analisis', contar=False)
+        if not estado or estado['generacion'] == self._generacion_analisis:
+            return 0
+        pendientes = [patron for generacion, patron in estado['patrones'] if generacion > self._generacion_analisis]
+        if estado['generacion'] < self._generacion_analisis or len(pendientes) < estado['generacion'] - self._generacion_analisis:
+            # Faltan patrones (o la cache compartida se reinició): vaciar todo es lo seguro
+            pendientes = ['*']
+        self._generacion_analisis = estado['generacion']
+        return sum(self.analisis_cache.invalidar(patron, prefijo='analisis:') for patron in pendientes)
+
+    def analizar_lote(self, mensajes: List[str]) -> List[Dict[str, Any]]:
+        """Analiza varios mensajes (sin memorizar) con una sola pasada de ``nlp.pipe``."""
+        docs = self.nlp.pipe([mensaje.lower() for mensaje in mensajes])
+        docs_originales = self.nlp.pipe(mensajes)
+        return [self._analizar_con_nlp(mensaje, doc, doc_original)
+                for mensaje, doc, doc_original in zip(mensajes, docs, docs_originales)]
+
+    def _analizar_con_nlp(self, mensaje: str, doc=None, doc_original=None) -> Dict[str, Any]:
+        """Análisis de ``analizar_mensaje`` sin memorizar, reutilizando los docs si ya se procesaron."""
+        # Procesar el mensaje con spaCy
+        if doc is None:
+            doc = self.nlp(mensaje.lower())
+        
+        # Verificar si es un saludo
+        if any(token.text in self.saludos for token in doc):
+            return {'intencion': 'saludo', 'ubicacion': None, 'similitudes': []}
+        
+        # Extraer entidades
+        entidades = self.extraer_entidades(mensaje, doc_original)
+        
+        if any(token.text in self.palabras_tendencia for token in doc):
+            intencion = 'tendencia'
+        elif self._pide_pronostico([self._eliminar_tildes(token.text) for token in doc]):
+            intencion = 'pronostico'
+        elif any(token.text in self.palabras_clima for token in doc):
+            intencion = 'clima'
+        elif any(token.text in self.palabras_hora for token in doc):
+            intencion = 'hora'
+        else:
+            intencion = None
+        
+        # Buscar ubicación en las entidades (GPE para países, ciudades, estados o LOC para ubicaciones)
+        ubicacion = None
+        if entidades['GPE']:
+            ubicacion = entidades['GPE'][0]  # Tomar la primera ubicación encontrada
+        elif entidades['LOC']:
+            ubicacion = entidades['LOC'][0]
+        
+        # Para el clima, si no se encontró en entidades, buscar sustantivos propios
+        if not ubicacion and intencion in ('clima', 'pronostico', 'tendencia'):
+            for ent in doc.ents:
+                if ent.label_ in ['GPE', 'LOC']:
+                    ubicacion = ent.text
+                    break
+        
+        # Si no se reconoce la intención, usar similitud de texto para sugerencias
+        similitudes = []
+        if intencion is None:
+            for token in doc:
+                # Buscar similitudes con palabras clave conocidas
+                if token.text in self.palabras_clima + self.palabras_hora + self.saludos:
+                    similitudes.append(token.text)
+        
+        return {'intencion': intencion, 'ubicacion': ubicacion, 'similitudes': sorted(set(similitudes))}
+
+    def obtener_contexto(self, sesion: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Devuelve el contexto guardado de una conversación (última ubicación resuelta) o None."""
+        if not sesion:
+            return None
+        return self.contextos.obtener('contexto', sesion[:CONTEXTO_MAX_LARGO_SESION])
+
+    def recordar_contexto(self, sesion: Optional[str], ubicacion: str, respuesta: Any, intencion: str) -> None:
+        """
+        Guarda la ubicación, coordenadas y zona horaria de una respuesta para los siguientes turnos.
+        
+        Args:
+            sesion: Identificador de la conversación (si es None no se guarda nada)
+            ubicacion: Ubicación tal como se consultó
+            respuesta: Respuesta de clima u hora
+            intencion: 'clima', 'pronostico' o 'hora'
+        """
+        if not sesion or not isinstance(respuesta, dict) or 'error' in respuesta:
+            return
+        datos = {'ubicacion': ubicacion, 'location': respuesta.get('location'), 'intencion': intencion}
+        if respuesta.get('coordinates'):
+            datos['lat'] = respuesta['coordinates']['lat']
+            datos['lon'] = respuesta['coordinates']['lon']
+        if respuesta.get('timezone'):
+            datos['timezone'] = respuesta['timezone']
+
+        def fusionar(anterior: Optional[Dict]) -> Dict:
+            # Conservar lo ya resuelto si se sigue hablando de la misma ubicación
+            if anterior and anterior.get('ubicacion') == ubicacion:
+                return {**anterior, **datos}
+            return datos
+
+        self.contextos.actualizar('contexto', sesion[:CONTEXTO_MAX_LARGO_SESION], fusionar, CONTEXTO_TTL)
+
+    def _es_seguimiento(self, mensaje: str) -> bool:
+        """Detecta preguntas de seguimiento como '¿y la hora?' o '¿y mañana?'."""
+        texto = self._eliminar_tildes(mensaje).strip(' ¿?¡!.,')
+        return texto == 'y' or texto.startswith('y ')
+
+    def _clima_desde_contexto(self, contexto: Dict[str, Any]) -> dict:
+        """Clima de la ubicación de la conversación, sin volver a geocodificar."""
+        if contexto.get('lat') is not None and contexto.get('lon') is not None:
+            return self.obtener_clima_por_coordenadas(contexto['lat'], contexto['lon'])
+        return self.obtener_clima_actual(contexto['ubicacion'])
+
+    def _pronostico_desde_contexto(self, contexto: Dict[str, Any]) -> dict:
+        """Pronóstico de la ubicación de la conversación, sin volver a geocodificar."""
+        if contexto.get('lat') is not None and contexto.get('lon') is not None:
+            return self.obtener_pronostico_por_coordenadas(contexto['lat'], contexto['lon'])
+        return self.obtener_pronostico(contexto['ubicacion'])
+
+    def _hora_desde_contexto(self, contexto: Dict[str, Any]) -> dict:
+        """Hora de la ubicación de la conversación, sin volver a geocodificar."""
+        if contexto.get('timezone') or contexto.get('lat') is not None:
+            timezone_info = self.obtener_zona_horaria(
+                contexto.get('lat'), contexto.get('lon'), zona_horaria=contexto.get('timezone')
+            )
+            if 'error' not in timezone_info:
+                return self._respuesta_hora(contexto.get('location') or contexto['ubicacion'], timezone_info)
+        return self.obtener_hora_ciudad(contexto['ubicacion'])
+
+    def procesar_mensaje(self, mensaje: str, analisis: Optional[Dict[str, Any]] = None,
+                         sesion: Optional[str] = None) -> str:
         """
         Procesa el mensaje del usuario y devuelve una respuesta utilizando spaCy.
         
         Args:
             mensaje: Mensaje del usuario
+            analisis: Resultado previo de ``analizar_mensaje``, para no repetir el análisis
+            sesion: Identificador de la conversación; si el mensaje no menciona una
+                ubicación se reutiliza la del turno anterior
             
         Returns:
             str: Respuesta del chatbot
@@ -668,84 +2582,197 @@ class ChatbotClima:
         if not mensaje or not isinstance(mensaje, str):
             return "No entendí tu mensaje. ¿Podrías repetirlo?"
         
-        # Procesar el mensaje con spaCy
-        doc = self.nlp(mensaje.lower())
+        analisis = analisis or self.analizar_mensaje(mensaje)
+        ubicacion = analisis['ubicacion']
+        intencion = analisis['intencion']
         
         # Verificar si es un saludo
-        if any(token.text in self.saludos for token in doc):
+        if intencion == 'saludo':
             return "¡Hola! Soy tu asistente del clima. ¿En qué puedo ayudarte hoy?"
         
-        # Extraer entidades
-        entidades = self.extraer_entidades(mensaje)
+        # Sin ubicación en el mensaje: reutilizar la del turno anterior de la conversación
+        contexto = self.obtener_contexto(sesion) if not ubicacion else None
+        if contexto and intencion is None and self._es_seguimiento(mensaje):
+            intencion = contexto.get('intencion')
         
         # Verificar si se pregunta por el clima
-        if any(token.text in self.palabras_clima for token in doc):
-            ubicacion = None
-            
-            # Buscar ubicación en las entidades (GPE para países, ciudades, estados o LOC para ubicaciones)
-            if entidades['GPE']:
-                ubicacion = entidades['GPE'][0]  # Tomar la primera ubicación encontrada
-            elif entidades['LOC']:
-                ubicacion = entidades['LOC'][0]
-            
-            # Si no se encontró en entidades, buscar sustantivos propios
-            if not ubicacion:
-                for ent in doc.ents:
-                    if ent.label_ in ['GPE', 'LOC']:
-                        ubicacion = ent.text
-                        break
-            
-            if ubicacion:
-                try:
+        if intencion == 'clima':
+            if not ubicacion and not contexto:
+                return "¿De qué ubicación te gustaría saber el clima? Por favor, especifica una ciudad o país."
+            try:
+                if ubicacion:
                     clima = self.obtener_clima_actual(ubicacion)
-                    if 'error' in clima:
-                        return f"No pude obtener el clima para {ubicacion}. ¿Podrías ser más específico?"
-                    
-                    # Return the structured data instead of formatted text
-                    return clima
-                except Exception as e:
-                    logging.error(f"Error al obtener clima: {e}", exc_info=True)
-                    return f"Lo siento, hubo un error al obtener el clima para {ubicacion}."
+                else:
+                    ubicacion = contexto['ubicacion']
+                    logger.info(f"💭 Reutilizando la ubicación de la conversación: {ubicacion}")
+                    clima = self._clima_desde_contexto(contexto)
+                if 'error' in clima:
+                    return f"No pude obtener el clima para {ubicacion}. ¿Podrías ser más específico?"
+                
+                self.recordar_contexto(sesion, ubicacion, clima, 'clima')
+                # Return the structured data instead of formatted text
+                return clima
+            except CuotaAgotadaError:
+                raise
+            except Exception as e:
+                logging.error(f"Error al obtener clima: {e}", exc_info=True)
+                return f"Lo siento, hubo un error al obtener el clima para {ubicacion}."
+        
+        # Verificar si se pide el pronóstico (incluye seguimientos como '¿y mañana?')
+        elif intencion == 'pronostico':
+            if not ubicacion and not contexto:
+                return "¿De qué ubicación te gustaría saber el pronóstico? Por favor, especifica una ciudad o país."
+            try:
+                if ubicacion:
+                    pronostico = self.obtener_pronostico(ubicacion)
+                else:
+                    ubicacion = contexto['ubicacion']
+                    logger.info(f"💭 Reutilizando la ubicación de la conversación: {ubicacion}")
+                    pronostico = self._pronostico_desde_contexto(contexto)
+                if 'error' in pronostico:
+                    return f"No pude obtener el pronóstico para {ubicacion}. ¿Podrías ser más específico?"
+                
+                self.recordar_contexto(sesion, ubicacion, pronostico, 'pronostico')
+                return pronostico
+            except CuotaAgotadaError:
+                raise
+            except Exception as e:
+                logging.error(f"Error al obtener pronóstico: {e}", exc_info=True)
+                return f"Lo siento, hubo un error al obtener el pronóstico para {ubicacion}."
+        
+        # Verificar si se pregunta cómo ha cambiado el clima (solo con el historial registrado)
+        elif intencion == 'tendencia':
+            if not ubicacion and not contexto:
+                return "¿De qué ubicación te gustaría saber cómo ha cambiado el clima? Por favor, especifica una ciudad o país."
+            if ubicacion:
+                tendencias = self.obtener_tendencias(ubicacion)
+            elif contexto.get('lat') is not None and contexto.get('lon') is not None:
+                tendencias = self.obtener_tendencias_por_coordenadas(contexto['lat'], contexto['lon'])
             else:
-                return "¿De qué ubicación te gustaría saber el clima? Por favor, especifica una ciudad o país."
+                tendencias = self.obtener_tendencias(contexto['ubicacion'])
+            if 'error' in tendencias:
+                return tendencias['error']
+            return self._describir_tendencia(tendencias)
         
         # Verificar si se pregunta por la hora
-        elif any(token.text in self.palabras_hora for token in doc):
-            ubicacion = None
-            
-            # Buscar ubicación en las entidades
-            if entidades['GPE']:
-                ubicacion = entidades['GPE'][0]
-            elif entidades['LOC']:
-                ubicacion = entidades['LOC'][0]
-            
-            # Si no se encontró ubicación, usar 'aquí'
-            if not ubicacion:
-                ubicacion = 'aquí'
-                
+        elif intencion == 'hora':
             try:
-                hora_info = self.obtener_hora_ciudad(ubicacion)
+                if ubicacion:
+                    hora_info = self.obtener_hora_ciudad(ubicacion)
+                elif contexto:
+                    ubicacion = contexto['ubicacion']
+                    logger.info(f"💭 Reutilizando la ubicación de la conversación: {ubicacion}")
+                    hora_info = self._hora_desde_contexto(contexto)
+                else:
+                    # Si no se encontró ubicación, usar 'aquí'
+                    ubicacion = 'aquí'
+                    hora_info = self.obtener_hora_ciudad(ubicacion)
                 if 'error' in hora_info:
                     return f"No pude obtener la hora para {ubicacion}."
                 
+                self.recordar_contexto(sesion, ubicacion, hora_info, 'hora')
                 # Return the structured data instead of formatted text
                 return hora_info
+            except CuotaAgotadaError:
+                raise
             except Exception as e:
                 logging.error(f"Error al obtener hora: {e}", exc_info=True)
                 return f"Lo siento, no pude obtener la hora para {ubicacion}."
         
-        # Si no se reconoce la intención, usar similitud de texto para sugerencias
-        similitudes = []
-        for token in doc:
-            # Buscar similitudes con palabras clave conocidas
-            if token.text in self.palabras_clima + self.palabras_hora + self.saludos:
-                similitudes.append(token.text)
-        
-        if similitudes:
-            return f"No estoy seguro de cómo ayudarte con eso. ¿Te refieres a algo relacionado con: {', '.join(set(similitudes))}?"
+        if analisis['similitudes']:
+            return f"No estoy seguro de cómo ayudarte con eso. ¿Te refieres a algo relacionado con: {', '.join(analisis['similitudes'])}?"
         
         return "No estoy seguro de cómo ayudarte. ¿Te gustaría saber el clima o la hora en alguna ubicación? Puedes preguntarme cosas como '¿Qué clima hace en Madrid?' o '¿Qué hora es en Tokio?'"
 
+    @staticmethod
+    def parsear_coordenadas(texto: str) -> Tuple[float, float]:
+        """Convierte 'lat,lon' en una tupla de floats. Lanza ValueError si el formato o el rango no son válidos."""
+        coords = texto.split(',')
+        if len(coords) != 2:
+            raise ValueError("Formato de coordenadas inválido")
+        lat = float(coords[0])
+        lon = float(coords[1])
+        if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
+            raise ValueError("Coordenadas fuera de rango")
+        return lat, lon
+
+    def procesar_mensaje_por_etapas(self, mensaje: str, sesion: Optional[str] = None) -> Iterator[Tuple[str, Any]]:
+        """
+        Procesa el mensaje entregando cada resultado parcial en cuanto está disponible.
+        
+        Acepta los mismos mensajes que /chat (``@coordenadas:``, ``@clima:``, ``@pronostico:``,
+        ``@hora:`` y texto libre). Para el clima entrega primero la ubicación resuelta, después la hora
+        local (calculada sin red a partir de las coordenadas) y por último el clima.
+        
+        Args:
+            mensaje: Mensaje del usuario
+            sesion: Identificador de la conversación (ver ``procesar_mensaje``)
+            
+        Yields:
+            Tuplas (etapa, datos) con etapa 'ubicacion', 'hora', 'clima', 'pronostico', 'respuesta' o 'error'
+        """
+        if mensaje.startswith('@coordenadas:'):
+            lat, lon = self.parsear_coordenadas(mensaje.replace('@coordenadas:', ''))
+            yield 'ubicacion', {'coordinates': {'lat': lat, 'lon': lon}}
+            zona = self.obtener_zona_horaria(lat, lon)
+            if 'error' not in zona:
+                # Mismo formato que '@hora:' para que cada evento tenga un solo esquema
+                yield 'hora', self._respuesta_hora(f"{lat:.4f},{lon:.4f}", zona)
+            clima = self.obtener_clima_por_coordenadas(lat, lon)
+            self.recordar_contexto(sesion, f"{lat:.4f},{lon:.4f}", clima, 'clima')
+            yield 'clima', clima
+            return
+        
+        if mensaje.startswith('@hora:'):
+            ubicacion = mensaje.replace('@hora:', '').strip().lower()
+            hora = self.obtener_hora_ciudad(ubicacion)
+            if 'error' in hora:
+                yield 'error', hora['error']
+            else:
+                self.recordar_contexto(sesion, ubicacion, hora, 'hora')
+                yield 'hora', hora
+            return
+        
+        if mensaje.startswith('@pronostico:'):
+            ubicacion = mensaje.replace('@pronostico:', '').strip().lower()
+            pronostico = self.obtener_pronostico(ubicacion)
+            if 'error' in pronostico:
+                yield 'error', pronostico['error']
+            else:
+                self.recordar_contexto(sesion, ubicacion, pronostico, 'pronostico')
+                yield 'pronostico', pronostico
+            return
+        
+        if mensaje.startswith('@clima:'):
+            ubicacion = mensaje.replace('@clima:', '').strip().lower()
+        else:
+            analisis = self.analizar_mensaje(mensaje)
+            if analisis['intencion'] != 'clima' or not analisis['ubicacion']:
+                respuesta = self.procesar_mensaje(mensaje, analisis, sesion)
+                if isinstance(respuesta, dict) and 'error' in respuesta:
+                    yield 'error', respuesta['error']
+                elif isinstance(respuesta, dict):
+                    yield {'time': 'hora', 'forecast': 'pronostico'}.get(respuesta.get('type'), 'clima'), respuesta
+                else:
+                    yield 'respuesta', respuesta
+                return
+            ubicacion = analisis['ubicacion']
+        
+        nombre, lat, lon, codigo_pais = self._resolver_ubicacion(ubicacion)
+        if not all([lat, lon]):
+            yield 'error', f"No pude encontrar la ubicación: {ubicacion}"
+            return
+        nombre_ubicacion = f"{nombre}{', ' + codigo_pais if codigo_pais else ''}"
+        yield 'ubicacion', {'location': nombre_ubicacion, 'coordinates': {'lat': lat, 'lon': lon}}
+        
+        zona = self.obtener_zona_horaria(lat, lon, codigo_pais, pais_usuario=ubicacion)
+        if 'error' not in zona:
+            yield 'hora', self._respuesta_hora(nombre_ubicacion, zona)
+        
+        clima = self.obtener_clima_por_coordenadas(lat, lon)
+        self.recordar_contexto(sesion, ubicacion, clima, 'clima')
+        yield 'clima', clima
+
     def _eliminar_tildes(self, texto: str) -> str:
         """Elimina tildes y caracteres especiales del texto."""
         reemplazos = {
@@ -814,13 +2841,145 @@ class ChatbotClima:
 def create_app():
     """Crea y configura la aplicación Flask."""
     app = Flask(__name__)
-    CORS(app)  # Enable CORS for all routes
+
+    # Configuración de CORS (única para toda la aplicación); max_age permite al
+    # navegador cachear el preflight y evitar un OPTIONS por cada mensaje
+    origenes = [origen.strip() for origen in CORS_ORIGENES.split(',') if origen.strip()]
+    CORS(
+        app,
+        origins=origenes if origenes != ['*'] else '*',
+        methods=['GET', 'POST', 'OPTIONS'],
+        expose_headers=['ETag', 'Retry-After', 'Server-Timing'],
+        max_age=CORS_MAX_AGE
+    )
     
     # Configuración de la aplicación
     app.config['JSON_AS_ASCII'] = False  # Para soportar caracteres especiales en las respuestas JSON
     
-    # Crear una instancia del chatbot
-    chatbot = ChatbotClima()
+    cache = CacheCompartida()
+    almacen = AlmacenPersistente()
+
+    def reclamar_al_iniciar(tarea: str) -> bool:
+        """
+        Reclama una tarea de arranque en la cache compartida para que la ejecute un solo
+        worker por despliegue (todos los workers de un despliegue comparten el proceso
+        maestro de Gunicorn). Devuelve True si este worker debe ejecutarla.
+        """
+        maestro = os.getppid()
+        reclamado = cache.actualizar(
+            'admin', tarea,
+            lambda actual: actual if actual and actual.get('maestro') == maestro
+            else {'pid': os.getpid(), 'maestro': maestro},
+            ttl=86400
+        )
+        return reclamado['pid'] == os.getpid()
+
+    # Compactar el almacén persistente y precargar la cache compartida (que ven todos los
+    # workers) una sola vez por despliegue para arrancar con la cache caliente
+    if reclamar_al_iniciar('precarga_inicial'):
+        almacen.compactar()
+        almacen.precargar(cache)
+    almacen.compactar_periodicamente(cache)
+    chatbot = ChatbotClima(cache, almacen)
+
+    # Precalentar las capitales de PAISES_INFO una sola vez por despliegue
+    if PRECALENTAR_AL_INICIAR and reclamar_al_iniciar('precalentamiento_inicial'):
+        chatbot.precalentar(list(PAISES_INFO))
+
+    def respuesta_ocupado(retry_after: float):
+        """Respuesta rápida 503 cuando no queda cuota de la API o capacidad para consultas costosas."""
+        logger.warning(f"⏳ Servicio ocupado, reintentar en {retry_after:.1f}s")
+        response = jsonify({
+            'respuesta': 'El servicio está ocupado en este momento. Por favor, inténtalo de nuevo en unos segundos.'
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
+
+    def cuerpo_ocupado(retry_after: float) -> Dict[str, Any]:
+        """Equivalente a ``respuesta_ocupado`` para los canales persistentes (WebSocket y SSE)."""
+        return {
+            'respuesta': 'El servicio está ocupado en este momento. Por favor, inténtalo de nuevo en unos segundos.',
+            'retry_after': max(1, math.ceil(retry_after))
+        }
+
+    # Carril rápido para mensajes baratos y cupo para los que consultan la API
+    admision = ControlAdmision()
+
+    # Métricas de serialización y compresión de las respuestas de este worker
+    estadisticas_respuestas = {
+        'respuestas': 0,
+        'no_modificadas': 0,
+        'bytes_json': 0,
+        'bytes_enviados': 0,
+        'ms_serializacion': 0.0,
+        'ms_compresion': 0.0,
+        'serializador': 'orjson' if orjson is not None else 'json'
+    }
+    lock_estadisticas = threading.Lock()
+
+    def max_age_para(datos: Any) -> int:
+        """Segundos que una respuesta puede reutilizarse según la frescura de sus datos (0 si es un error)."""
+        if not isinstance(datos, dict) or datos.get('stale') or 'error' in datos:
+            return 0
+        if datos.get('type') == 'time':
+            # La hora se muestra en minutos: vale hasta el cambio de minuto
+            return 60 - datetime.now().second
+        return HTTP_MAX_AGE_CLIMA
+
+    def respuesta_json(payload: Any, max_age: int = 0, publica: bool = False) -> Response:
+        """
+        Serializa una respuesta 200 con ETag derivado del contenido, Cache-Control y gzip.
+        
+        Solo las peticiones GET/HEAD son cacheables: llevan ETag y ``max_age`` y, si el
+        cliente envía un If-None-Match que coincide con el ETag, se responde 304 sin cuerpo.
+        El resto (POST) se responde siempre completo con ``Cache-Control: no-store``.
+        """
+        cacheable = request.method in ('GET', 'HEAD')
+        inicio = time.perf_counter()
+        if orjson is not None:
+            cuerpo = orjson.dumps(payload)
+        else:
+            cuerpo = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        ms_serializacion = (time.perf_counter() - inicio) * 1000
+        ms_compresion = 0.0
+        etag = hashlib.blake2b(cuerpo, digest_size=16).hexdigest()
+
+        if cacheable and request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(cuerpo, mimetype='application/json')
+            if len(cuerpo) >= RESPUESTA_COMPRIMIR_MIN_BYTES and 'gzip' in request.accept_encodings:
+                inicio = time.perf_counter()
+                comprimido = gzip.compress(cuerpo, compresslevel=6)
+                ms_compresion = (time.perf_counter() - inicio) * 1000
+                if len(comprimido) < len(cuerpo):
+                    response.set_data(comprimido)
+                    response.headers['Content-Encoding'] = 'gzip'
+
+        if cacheable:
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = (
+                f"{'public' if publica else 'private'}, max-age={max_age}" if max_age > 0 else 'no-cache'
+            )
+        else:
+            response.headers['Cache-Control'] = 'no-store'
+        response.vary.add('Accept-Encoding')
+        response.headers['Server-Timing'] = f"json;dur={ms_serializacion:.2f}, gzip;dur={ms_compresion:.2f}"
+
+        enviados = 0 if response.status_code == 304 else response.calculate_content_length()
+        with lock_estadisticas:
+            estadisticas_respuestas['respuestas'] += 1
+            estadisticas_respuestas['no_modificadas'] += response.status_code == 304
+            estadisticas_respuestas['bytes_json'] += len(cuerpo)
+            estadisticas_respuestas['bytes_enviados'] += enviados
+            estadisticas_respuestas['ms_serializacion'] += ms_serializacion
+            estadisticas_respuestas['ms_compresion'] += ms_compresion
+        logger.info(
+            f"📦 Respuesta {response.status_code}: {len(cuerpo)} bytes JSON → {enviados} enviados "
+            f"(json {ms_serializacion:.2f}ms, gzip {ms_compresion:.2f}ms)"
+        )
+        return response
     
     @app.route('/')
     def home():
@@ -830,21 +2989,293 @@ def create_app():
             'message': 'Weather Chatbot API is running',
             'endpoints': {
                 'chat': '/chat (POST)',
+                'chat_stream': '/chat/stream (GET, POST, text/event-stream)',
+                'clima': '/clima/<ubicacion> (GET)',
+                'pronostico': '/pronostico/<ubicacion> (GET)',
+                'tendencias': '/tendencias/<ubicacion>?horas=24 (GET)',
+                'hora': '/hora/<ubicacion> (GET)',
+                'websocket': '/ws (WebSocket, requiere flask-sock y WS_HABILITADO=1)',
+                'clima_multiple': '/clima/multiple (GET, POST)',
                 'status': '/ (GET)'
             }
         })
+
+    @app.route('/clima/multiple', methods=['GET', 'POST'])
+    def clima_multiple():
+        """Devuelve el clima de varias ubicaciones; por defecto, todas las capitales de CIUDADES_POR_PAIS."""
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            ubicaciones = data.get('ubicaciones')
+            if not isinstance(ubicaciones, list) or not all(isinstance(u, str) and u.strip() for u in ubicaciones):
+                return jsonify({'error': "El campo 'ubicaciones' debe ser una lista de nombres"}), 400
+        else:
+            ubicaciones = list(CIUDADES_POR_PAIS)
+
+        if len(ubicaciones) > CLIMA_MULTIPLE_MAX_UBICACIONES:
+            return jsonify({'error': f"Máximo {CLIMA_MULTIPLE_MAX_UBICACIONES} ubicaciones por solicitud"}), 400
+
+        logger.info(f"🌍 Consulta de clima múltiple para {len(ubicaciones)} ubicaciones")
+        climas = chatbot.obtener_clima_multiple([u.strip() for u in ubicaciones])
+        max_age = min((max_age_para(clima) for clima in climas), default=0)
+        return respuesta_json({'respuesta': climas}, max_age=max_age, publica=True)
+
+    @app.route('/clima/<ubicacion>')
+    def clima_ubicacion(ubicacion: str):
+        """Clima actual de una ubicación; equivalente cacheable de '@clima:' en /chat."""
+        try:
+            clima = chatbot.obtener_clima_actual(ubicacion.strip().lower())
+        except CuotaAgotadaError as e:
+            return respuesta_ocupado(e.retry_after)
+        if 'error' in clima:
+            return jsonify({'respuesta': clima['error']}), 400
+        return respuesta_json({'respuesta': clima}, max_age=max_age_para(clima), publica=True)
+
+    @app.route('/pronostico/<ubicacion>')
+    def pronostico_ubicacion(ubicacion: str):
+        """Pronóstico diario de una ubicación; equivalente cacheable de '@pronostico:' en /chat."""
+        try:
+            pronostico = chatbot.obtener_pronostico(ubicacion.strip().lower())
+        except CuotaAgotadaError as e:
+            return respuesta_ocupado(e.retry_after)
+        if 'error' in pronostico:
+            return jsonify({'respuesta': pronostico['error']}), 400
+        return respuesta_json({'respuesta': pronostico}, max_age=max_age_para(pronostico), publica=True)
+
+    @app.route('/tendencias/<ubicacion>')
+    def tendencias_ubicacion(ubicacion: str):
+        """Resumen del clima registrado por todos los workers para una ubicación (``?horas=``, por defecto 24)."""
+        try:
+            horas = float(request.args.get('horas', 24))
+        except ValueError:
+            horas = 0
+        if not 0 < horas <= HISTORIAL_MAX_HORAS:
+            return jsonify({'error': f"'horas' debe ser un número entre 0 y {HISTORIAL_MAX_HORAS}"}), 400
+        try:
+            tendencias = chatbot.obtener_tendencias(ubicacion.strip().lower(), horas)
+        except CuotaAgotadaError as e:
+            return respuesta_ocupado(e.retry_after)
+        if 'error' in tendencias:
+            return jsonify({'respuesta': tendencias['error']}), 404
+        return respuesta_json({'respuesta': tendencias})
+
+    @app.route('/hora/<ubicacion>')
+    def hora_ubicacion(ubicacion: str):
+        """Hora local de una ubicación; equivalente cacheable de '@hora:' en /chat."""
+        try:
+            hora = chatbot.obtener_hora_ciudad(ubicacion.strip().lower())
+        except CuotaAgotadaError as e:
+            return respuesta_ocupado(e.retry_after)
+        if 'error' in hora:
+            return jsonify({'respuesta': hora['error']}), 400
+        return respuesta_json({'respuesta': hora}, max_age=max_age_para(hora), publica=True)
+
+    @app.route('/estadisticas')
+    def estadisticas():
+        """
+        Métricas de este worker (respuestas con bytes y tiempo de serialización/compresión,
+        cache de análisis NLP y admisión) y del historial compartido por todos los workers.
+        """
+        with lock_estadisticas:
+            respuestas = dict(estadisticas_respuestas)
+        respuestas['bytes_ahorrados'] = respuestas['bytes_json'] - respuestas['bytes_enviados']
+        analisis_nlp = {'por_worker': True, **chatbot.analisis_cache.estadisticas()}
+        if chatbot.analizador_procesos is not None:
+            analisis_nlp['pool'] = chatbot.analizador_procesos.estadisticas()
+        return jsonify({
+            'pid': os.getpid(),
+            'respuestas': respuestas,
+            'analisis_nlp': analisis_nlp,
+            'historial': chatbot.historial.estadisticas(),
+            'admision_chat': admision.estadisticas()
+        })
+    
+    def requiere_admin(vista: Callable) -> Callable:
+        """Protege una ruta con 'Authorization: Bearer <ADMIN_TOKEN>'; sin token configurado responde 404."""
+        @wraps(vista)
+        def envoltura(*args, **kwargs):
+            if not ADMIN_TOKEN:
+                return jsonify({'error': 'Recurso no encontrado'}), 404
+            cabecera = request.headers.get('Authorization', '')
+            token = cabecera[len('Bearer '):] if cabecera.startswith('Bearer ') else ''
+            if not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+                logger.warning(f"🔒 Acceso de administración rechazado desde {request.remote_addr}")
+                response = jsonify({'error': 'No autorizado'})
+                response.status_code = 401
+                response.headers['WWW-Authenticate'] = 'Bearer'
+                return response
+            return vista(*args, **kwargs)
+        return envoltura
+
+    @app.route('/admin/cache')
+    @requiere_admin
+    def admin_cache():
+        """Tamaño, memoria, tasa de aciertos y claves más consultadas de cada cache."""
+        return jsonify({
+            'pid': os.getpid(),
+            'compartida': cache.inspeccionar(),
+            'contextos': chatbot.contextos.inspeccionar(max_claves=0),
+            'analisis_nlp': {'por_worker': True, **chatbot.analisis_cache.inspeccionar()},
+            'cuota': chatbot.limitador.estado()
+        })
+
+    @app.route('/admin/cache/invalidar', methods=['POST'])
+    @requiere_admin
+    def admin_invalidar():
+        """
+        Elimina las entradas cuya clave 'espacio:clave' coincide con el patrón fnmatch
+        del cuerpo, p. ej. {"patron": "clima:*"}. El espacio 'analisis' corresponde a la
+        cache de análisis NLP de cada worker: se vacía en este y los demás workers la
+        aplican en su siguiente mensaje.
+        """
+        data = request.get_json(silent=True) or {}
+        patron = data.get('patron')
+        if not isinstance(patron, str) or not patron:
+            return jsonify({'error': "El campo 'patron' es obligatorio"}), 400
+        eliminadas = {
+            'compartida': cache.invalidar(patron),
+            'persistente': almacen.invalidar(patron),
+            'analisis_nlp': chatbot.invalidar_analisis(patron)
+        }
+        logger.info(f"🧹 Invalidación '{patron}': {eliminadas}")
+        return jsonify({'pid': os.getpid(), 'patron': patron, 'eliminadas': eliminadas})
+
+    @app.route('/admin/precalentar', methods=['GET', 'POST'])
+    @requiere_admin
+    def admin_precalentar():
+        """Inicia (POST) o consulta (GET) el precalentamiento; por defecto, todas las capitales de PAISES_INFO."""
+        if request.method == 'GET':
+            return jsonify({'precalentamiento': chatbot.estado_precalentamiento()})
+        data = request.get_json(silent=True) or {}
+        ubicaciones = data.get('ubicaciones', list(PAISES_INFO))
+        if not isinstance(ubicaciones, list) or not all(isinstance(u, str) and u.strip() for u in ubicaciones):
+            return jsonify({'error': "El campo 'ubicaciones' debe ser una lista de nombres"}), 400
+        if not chatbot.precalentar([u.strip().lower() for u in ubicaciones]):
+            return jsonify({'error': 'Ya hay un precalentamiento en curso',
+                            'precalentamiento': chatbot.estado_precalentamiento()}), 409
+        return jsonify({'precalentamiento': chatbot.estado_precalentamiento()}), 202
     
-    @app.route('/chat', methods=['POST', 'OPTIONS'])
+    def costo_de(data: Any, sesion: Optional[str] = None) -> str:
+        """Clasifica con ``clasificar_costo`` un mensaje con el protocolo de ``atender_mensaje``."""
+        if not isinstance(data, dict):
+            return 'barata'
+        if isinstance(data.get('sesion'), str):
+            sesion = data['sesion']
+        return chatbot.clasificar_costo(data.get('mensaje'), sesion)
+
+    def atender_mensaje(data: Any, sesion: Optional[str] = None) -> Tuple[Dict, int]:
+        """
+        Responde a un mensaje de chat con el protocolo común a /chat y al WebSocket.
+        
+        Args:
+            data: Cuerpo de la solicitud con 'mensaje' (y opcionalmente 'accuracy' y 'sesion')
+            sesion: Identificador de la conversación si no viene en ``data``
+            
+        Returns:
+            Tupla (cuerpo de la respuesta, código de estado HTTP)
+            
+        Raises:
+            CuotaAgotadaError: Si no queda cuota de la API ni datos en cache
+        """
+        # Validar mensaje
+        if not isinstance(data, dict) or not isinstance(data.get('mensaje'), str):
+            logger.error("❌ Falta el campo 'mensaje' en la solicitud")
+            return {'error': 'Formato de solicitud inválido'}, 400
+        
+        mensaje = data['mensaje'].strip()
+        if isinstance(data.get('sesion'), str):
+            sesion = data['sesion']
+        logger.info(f"💬 Mensaje recibido: {mensaje}")
+
+        # Manejar mensajes con coordenadas
+        if mensaje.startswith('@coordenadas:'):
+            try:
+                # Extraer y validar coordenadas
+                lat, lon = chatbot.parsear_coordenadas(mensaje.replace('@coordenadas:', ''))
+            
+                # Registrar precisión si está disponible
+                accuracy = data.get('accuracy')
+                if accuracy:
+                    logger.info(f"📍 Precisión GPS: ±{round(accuracy)}m")
+            
+                logger.info(f"📍 Procesando coordenadas: lat={lat:.6f}, lon={lon:.6f}")
+            
+                # Obtener clima para las coordenadas
+                clima = chatbot.obtener_clima_por_coordenadas(lat, lon)
+                chatbot.recordar_contexto(sesion, f"{lat:.4f},{lon:.4f}", clima, 'clima')
+                return {'respuesta': clima}, 200
+            
+            except CuotaAgotadaError:
+                raise
+            except ValueError as e:
+                logger.error(f"❌ Error en formato de coordenadas: {str(e)}")
+                return {'respuesta': 'Formato de coordenadas inválido. Por favor, inténtalo de nuevo.'}, 400
+            except WeatherAPIError as e:
+                logger.error(f"❌ Error al obtener clima: {str(e)}")
+                return {'respuesta': f'Error al obtener el clima: {str(e)}'}, 500
+            except Exception as e:
+                logger.error(f"❌ Error procesando coordenadas: {str(e)}")
+                return {'respuesta': 'Error al procesar tu ubicación. Por favor, inténtalo de nuevo.'}, 500
+
+        # Manejar mensajes directos de clima
+        if mensaje.startswith('@clima:'):
+            pais = mensaje.replace('@clima:', '').strip().lower()
+            logger.info(f"🌦️ Consulta directa de clima para: {pais}")
+            clima = chatbot.obtener_clima_actual(pais)
+            if 'error' in clima:
+                return {'respuesta': clima['error']}, 400
+            chatbot.recordar_contexto(sesion, pais, clima, 'clima')
+            return {'respuesta': clima}, 200
+
+        # Manejar mensajes directos de pronóstico
+        if mensaje.startswith('@pronostico:'):
+            pais = mensaje.replace('@pronostico:', '').strip().lower()
+            logger.info(f"📅 Consulta directa de pronóstico para: {pais}")
+            pronostico = chatbot.obtener_pronostico(pais)
+            if 'error' in pronostico:
+                return {'respuesta': pronostico['error']}, 400
+            chatbot.recordar_contexto(sesion, pais, pronostico, 'pronostico')
+            return {'respuesta': pronostico}, 200
+
+        # Manejar mensajes directos de hora
+        if mensaje.startswith('@hora:'):
+            pais = mensaje.replace('@hora:', '').strip().lower()
+            logger.info(f"🕒 Consulta directa de hora para: {pais}")
+            hora = chatbot.obtener_hora_ciudad(pais)
+            if 'error' in hora:
+                return {'respuesta': hora['error']}, 400
+            chatbot.recordar_contexto(sesion, pais, hora, 'hora')
+            return {'respuesta': hora}, 200
+
+        # Procesar mensaje normal
+        logger.info("🔄 Procesando mensaje normal")
+        try:
+            respuesta = chatbot.procesar_mensaje(mensaje, sesion=sesion)
+
+            # Si la respuesta es un dict con error, devolver error
+            if isinstance(respuesta, dict) and 'error' in respuesta:
+                logger.info(f"❌Respuesta de error: {respuesta['error']}")
+                return {'respuesta': respuesta['error']}, 400
+
+            # Si es dict con datos de clima/hora, devolver tal cual
+            if isinstance(respuesta, dict):
+                logger.info(f"✅ Respuesta generada (objeto): {json.dumps(respuesta, ensure_ascii=False)}")
+                return {'respuesta': respuesta}, 200
+
+            # Si es string, devolver como texto
+            logger.info(f"✅ Respuesta generada (texto): {str(respuesta)[:200]}...")
+            return {'respuesta': respuesta}, 200
+
+        except CuotaAgotadaError:
+            raise
+        except Exception as e:
+            logger.error(f"❌Error al procesar el mensaje: {str(e)}", exc_info=True)
+            return {'respuesta': '❌Ocurrió un error al procesar tu mensaje. Por favor, inténtalo de nuevo.'}, 500
+
+    @app.route('/chat', methods=['POST'])
     def chat():
         """Maneja las solicitudes de chat del usuario."""
-        if request.method == 'OPTIONS':
-            # Handle preflight request
-            response = jsonify({'status': 'ok'})
-            response.headers.add('Access-Control-Allow-Origin', '*')
-            response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-            response.headers.add('Access-Control-Allow-Methods', 'POST')
-            return response
-            
+        # Las solicitudes OPTIONS (preflight) las responde Flask y flask-cors añade
+        # Access-Control-Max-Age para que el navegador las reutilice.
         try:
             # Registrar inicio de solicitud
             logger.info("\n" + "="*80)
@@ -861,99 +3292,19 @@ def create_app():
                 logger.error(f"❌ Error al decodificar JSON: {str(e)}")
                 return jsonify({'error': 'Formato de solicitud inválido'}), 400
             
-            # Validar mensaje
-            if not data or 'mensaje' not in data:
-                logger.error("❌ Falta el campo 'mensaje' en la solicitud")
-                return jsonify({'error': 'Formato de solicitud inválido'}), 400
-            
-            mensaje = data.get('mensaje', '').strip()
-            logger.info(f"💬 Mensaje recibido: {mensaje}")
-
-            # Manejar mensajes con coordenadas
-            if mensaje.startswith('@coordenadas:'):
-                try:
-                    # Extraer y validar coordenadas
-                    coords = mensaje.replace('@coordenadas:', '').split(',')
-                    if len(coords) != 2:
-                        raise ValueError("Formato de coordenadas inválido")
-                
-                    lat = float(coords[0])
-                    lon = float(coords[1])
-                
-                    # Validar rango de coordenadas
-                    if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
-                        raise ValueError("Coordenadas fuera de rango")
-                
-                    # Registrar precisión si está disponible
-                    accuracy = data.get('accuracy')
-                    if accuracy:
-                        logger.info(f"📍 Precisión GPS: ±{round(accuracy)}m")
-                
-                    logger.info(f"📍 Procesando coordenadas: lat={lat:.6f}, lon={lon:.6f}")
-                
-                    # Obtener clima para las coordenadas
-                    respuesta = chatbot.obtener_clima_por_coordenadas(lat, lon)
-                    return jsonify({'respuesta': respuesta})
-                
-                except ValueError as e:
-                    logger.error(f"❌ Error en formato de coordenadas: {str(e)}")
-                    return jsonify({
-                        'respuesta': 'Formato de coordenadas inválido. Por favor, inténtalo de nuevo.'
-                    }), 400
-                except WeatherAPIError as e:
-                    logger.error(f"❌ Error al obtener clima: {str(e)}")
-                    return jsonify({
-                        'respuesta': f'Error al obtener el clima: {str(e)}'
-                    }), 500
-                except Exception as e:
-                    logger.error(f"❌ Error procesando coordenadas: {str(e)}")
-                    return jsonify({
-                        'respuesta': 'Error al procesar tu ubicación. Por favor, inténtalo de nuevo.'
-                    }), 500
-
-            # Manejar mensajes directos de clima
-            if mensaje.startswith('@clima:'):
-                pais = mensaje.replace('@clima:', '').strip().lower()
-                logger.info(f"🌦️ Consulta directa de clima para: {pais}")
-                clima = chatbot.obtener_clima_actual(pais)
-                if 'error' in clima:
-                    return jsonify({'respuesta': clima['error']}), 400
-                return jsonify({'respuesta': clima})
-
-            # Manejar mensajes directos de hora
-            if mensaje.startswith('@hora:'):
-                pais = mensaje.replace('@hora:', '').strip().lower()
-                logger.info(f"🕒 Consulta directa de hora para: {pais}")
-                hora = chatbot.obtener_hora_ciudad(pais)
-                if 'error' in hora:
-                    return jsonify({'respuesta': hora['error']}), 400
-                return jsonify({'respuesta': hora})
-
-            # Procesar mensaje normal
-            logger.info("🔄 Procesando mensaje normal")
-            try:
-                respuesta = chatbot.procesar_mensaje(mensaje)
-
-                # Si la respuesta es un dict con error, devolver error
-                if isinstance(respuesta, dict) and 'error' in respuesta:
-                    logger.info(f"❌Respuesta de error: {respuesta['error']}")
-                    return jsonify({'respuesta': respuesta['error']}), 400
-
-                # Si es dict con datos de clima/hora, devolver tal cual
-                if isinstance(respuesta, dict):
-                    logger.info(f"✅ Respuesta generada (objeto): {json.dumps(respuesta, ensure_ascii=False)}")
-                    return jsonify({'respuesta': respuesta})
-
-                # Si es string, devolver como texto
-                logger.info(f"✅ Respuesta generada (texto): {str(respuesta)[:200]}...")
-                return jsonify({'respuesta': respuesta})
-
-            except Exception as e:
-                logger.error(f"❌Error al procesar el mensaje: {str(e)}", exc_info=True)
-                return jsonify({
-                    'respuesta': '❌Ocurrió un error al procesar tu mensaje. Por favor, inténtalo de nuevo.'
-                }), 500
+            # Clasificar antes de hacer trabajo: los mensajes costosos sin hueco se rechazan ya
+            sesion = request.headers.get('X-Session-Id')
+            with admision.carril(costo_de(data, sesion)) as admitida:
+                if not admitida:
+                    logger.warning("🚦 Consulta costosa rechazada por sobrecarga")
+                    return respuesta_ocupado(admision.reintentar_en())
+                cuerpo, status = atender_mensaje(data, sesion=sesion)
+            if status == 200:
+                return respuesta_json(cuerpo)
+            return jsonify(cuerpo), status
 
+        except CuotaAgotadaError as e:
+            return respuesta_ocupado(e.retry_after)
         except Exception as e:
             logger.error(f"❌ERROR NO MANEJADO en la ruta /chat: {str(e)}", exc_info=True)
             return jsonify({
@@ -961,6 +3312,109 @@ def create_app():
             }), 500
         finally:
             logger.info("✅Solicitud finalizada\n" + "="*80 + "\n")
+
+    if WS_HABILITADO and Sock is None:
+        logger.warning("⚠️ WS_HABILITADO=1 pero flask-sock no está instalado: /ws no estará disponible")
+    if WS_HABILITADO and Sock is not None:
+        sock = Sock(app)
+        # Cada conexión retiene un hilo del worker: limitarlas para que /chat y el resto
+        # de rutas sigan teniendo hilos libres
+        conexiones_ws = threading.BoundedSemaphore(max(1, WS_MAX_CONEXIONES))
+
+        @sock.route('/ws')
+        def chat_ws(ws):
+            """
+            Canal WebSocket persistente con el mismo protocolo que /chat.
+            
+            Cada mensaje puede ser texto plano o un JSON como el cuerpo de /chat; cada
+            respuesta es un JSON con 'respuesta' y 'status' (el código que daría /chat).
+            """
+            if not conexiones_ws.acquire(blocking=False):
+                logger.warning("🔌 Conexión WebSocket rechazada: límite de conexiones del worker alcanzado")
+                ws.send(json.dumps({
+                    'respuesta': 'Hay demasiadas conexiones abiertas. Usa /chat o inténtalo más tarde.',
+                    'status': 503
+                }, ensure_ascii=False))
+                ws.close()
+                return
+            try:
+                # La propia conexión es la conversación, salvo que el cliente indique su sesión
+                sesion = request.args.get('sesion') or uuid.uuid4().hex
+                logger.info("🔌 Conexión WebSocket abierta")
+                while True:
+                    texto = ws.receive(timeout=WS_INACTIVIDAD)
+                    if texto is None:
+                        logger.info("🔌 Conexión WebSocket cerrada por inactividad")
+                        ws.close()
+                        return
+                    try:
+                        data = json.loads(texto)
+                    except ValueError:
+                        data = None
+                    if not isinstance(data, dict):
+                        data = {'mensaje': texto}
+                    # Cada mensaje pasa por el control de admisión, igual que en /chat
+                    with admision.carril(costo_de(data, sesion)) as admitida:
+                        if not admitida:
+                            logger.warning("🚦 Consulta costosa rechazada por sobrecarga (WebSocket)")
+                            cuerpo, status = cuerpo_ocupado(admision.reintentar_en()), 503
+                        else:
+                            try:
+                                cuerpo, status = atender_mensaje(data, sesion=sesion)
+                            except CuotaAgotadaError as e:
+                                cuerpo, status = cuerpo_ocupado(e.retry_after), 503
+                            except Exception as e:
+                                logger.error(f"❌Error al procesar el mensaje (WebSocket): {str(e)}", exc_info=True)
+                                cuerpo, status = {'respuesta': '❌Ocurrió un error al procesar tu mensaje. Por favor, inténtalo de nuevo.'}, 500
+                    ws.send(json.dumps({**cuerpo, 'status': status}, ensure_ascii=False))
+            finally:
+                conexiones_ws.release()
+    
+    @app.route('/chat/stream', methods=['GET', 'POST'])
+    def chat_stream():
+        """Versión Server-Sent Events de /chat: envía cada etapa en cuanto está lista."""
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+        else:
+            data = request.args
+        mensaje = data.get('mensaje', '')
+        mensaje = mensaje.strip() if isinstance(mensaje, str) else ''
+        sesion = data.get('sesion') or request.headers.get('X-Session-Id')
+        sesion = sesion if isinstance(sesion, str) else None
+        if not mensaje:
+            return jsonify({'error': 'Formato de solicitud inválido'}), 400
+        
+        logger.info(f"📡 Mensaje recibido (stream): {mensaje}")
+        costo = chatbot.clasificar_costo(mensaje, sesion)
+
+        def evento(nombre: str, datos: Dict) -> str:
+            return f"event: {nombre}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+        def generar():
+            # El carril se ocupa mientras se generan las etapas, que es cuando se consulta la API
+            with admision.carril(costo) as admitida:
+                if not admitida:
+                    logger.warning("🚦 Consulta costosa rechazada por sobrecarga (stream)")
+                    yield evento('error', cuerpo_ocupado(admision.reintentar_en()))
+                else:
+                    try:
+                        for etapa, datos in chatbot.procesar_mensaje_por_etapas(mensaje, sesion):
+                            yield evento(etapa, {'respuesta': datos})
+                    except CuotaAgotadaError as e:
+                        yield evento('error', cuerpo_ocupado(e.retry_after))
+                    except ValueError as e:
+                        logger.error(f"❌ Error en formato de coordenadas: {str(e)}")
+                        yield evento('error', {'respuesta': 'Formato de coordenadas inválido. Por favor, inténtalo de nuevo.'})
+                    except Exception as e:
+                        logger.error(f"❌Error al procesar el mensaje (stream): {str(e)}", exc_info=True)
+                        yield evento('error', {'respuesta': '❌Ocurrió un error al procesar tu mensaje. Por favor, inténtalo de nuevo.'})
+            yield evento('fin', {})
+
+        return Response(
+            stream_with_context(generar()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
     
     @app.errorhandler(404)
     def not_found_error(error):
@@ -987,6 +3441,13 @@ def test():
         'version': '1.0.0',
         'endpoints': {
             'chat': '/chat (POST)',
+            'chat_stream': '/chat/stream (GET, POST, text/event-stream)',
+            'clima': '/clima/<ubicacion> (GET)',
+            'pronostico': '/pronostico/<ubicacion> (GET)',
+            'tendencias': '/tendencias/<ubicacion>?horas=24 (GET)',
+            'hora': '/hora/<ubicacion> (GET)',
+            'websocket': '/ws (WebSocket, requiere flask-sock y WS_HABILITADO=1)',
+            'clima_multiple': '/clima/multiple (GET, POST)',
             'test': '/test (GET)',
             'status': '/ (GET)'
         }
@@ -0,0 +1,98 @@
+"""
+Compara el análisis NLP en el hilo de la petición con el pool de procesos (NLP_PROCESOS).
+
+Simula un worker gthread: varios hilos analizan mensajes distintos (para no acertar en la
+cache de análisis) mientras otro hilo hace esperas cortas de E/S y mide cuánto se
+retrasan por la contención del GIL.
+
+Uso:
+    python benchmarks/nlp_procesos.py [--hilos 4] [--mensajes 400] [--procesos 2]
+"""
+import argparse
+import atexit
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# El worker de app.py no debe crear su propio pool al importarse
+os.environ['NLP_PROCESOS'] = '0'
+# Ni abrir la cache, el almacén SQLite, las conversaciones o el historial de producción
+_TEMPORAL = tempfile.mkdtemp(prefix='servidordeclima_benchmark_')
+atexit.register(shutil.rmtree, _TEMPORAL, ignore_errors=True)
+os.environ['CACHE_COMPARTIDA_RUTA'] = os.path.join(_TEMPORAL, 'cache.bin')
+os.environ['CACHE_PERSISTENTE_RUTA'] = os.path.join(_TEMPORAL, 'cache_clima.sqlite3')
+os.environ['CONTEXTO_RUTA'] = os.path.join(_TEMPORAL, 'contexto.bin')
+os.environ['HISTORIAL_RUTA'] = os.path.join(_TEMPORAL, 'historial.bin')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import CacheCompartida, ChatbotClima  # noqa: E402
+
+PLANTILLAS = [
+    "¿Qué clima hace en {ciudad}? ({n})",
+    "Dime la hora en {ciudad} por favor {n}",
+    "¿Va a llover hoy en {ciudad}? consulta {n}",
+    "Temperatura actual de {ciudad}, pregunta número {n}",
+]
+CIUDADES = ["Madrid", "Santiago de Chile", "Buenos Aires", "Lima", "Bogotá", "Ciudad de México", "Tokio"]
+ESPERA_E_S = 0.005  # seconds
+
+
+def generar_mensajes(cantidad):
+    """Mensajes distintos entre sí para que todos pasen por spaCy."""
+    return [
+        PLANTILLAS[i % len(PLANTILLAS)].format(ciudad=CIUDADES[i % len(CIUDADES)], n=i)
+        for i in range(cantidad)
+    ]
+
+
+def medir(chatbot, mensajes, hilos):
+    """Devuelve (mensajes por segundo, retrasos de E/S en ms) analizando con ``hilos`` hilos."""
+    retrasos = []
+    terminado = threading.Event()
+
+    def sondear_e_s():
+        while not terminado.is_set():
+            inicio = time.perf_counter()
+            time.sleep(ESPERA_E_S)
+            retrasos.append((time.perf_counter() - inicio - ESPERA_E_S) * 1000)
+
+    sonda = threading.Thread(target=sondear_e_s)
+    sonda.start()
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=hilos) as executor:
+        list(executor.map(chatbot.analizar_mensaje, mensajes))
+    duracion = time.perf_counter() - inicio
+    terminado.set()
+    sonda.join()
+    return len(mensajes) / duracion, retrasos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--hilos', type=int, default=4, help='hilos de petición simulados')
+    parser.add_argument('--mensajes', type=int, default=400, help='mensajes a analizar por modo')
+    parser.add_argument('--procesos', type=int, default=2, help='procesos del pool NLP')
+    args = parser.parse_args()
+
+    mensajes = generar_mensajes(args.mensajes)
+    modos = [('en el hilo', 0), (f'{args.procesos} procesos', args.procesos)]
+    print(f"{'modo':<14} {'msg/s':>9} {'E/S media ms':>13} {'E/S p95 ms':>11} {'lote medio':>11}")
+    for nombre, procesos in modos:
+        chatbot = ChatbotClima(CacheCompartida(ruta=None), nlp_procesos=procesos)
+        chatbot.analizar_mensaje('hola')  # calentar el modelo
+        rendimiento, retrasos = medir(chatbot, mensajes, args.hilos)
+        lote = '-'
+        if chatbot.analizador_procesos is not None:
+            lote = chatbot.analizador_procesos.estadisticas()['tamano_medio_lote']
+        p95 = statistics.quantiles(retrasos, n=20)[-1] if len(retrasos) >= 2 else 0.0
+        print(f"{nombre:<14} {rendimiento:>9.1f} {statistics.mean(retrasos or [0.0]):>13.2f} "
+              f"{p95:>11.2f} {lote:>11}")
+
+
+if __name__ == '__main__':
+    main()